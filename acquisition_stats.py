@@ -0,0 +1,83 @@
+"""acquisition_stats.py
+Real-time acquisition health: dropped frame detection and the per-run summary.
+"""
+import json
+from multiprocessing import Value, Array
+
+from NeuCams.utils import display
+
+class FrameGapDetector:
+    """Detects dropped frames from gaps in the hardware frame ids and in the timestamp intervals.
+    Counters are shared Values (per run and total), the first max_gaps gap locations of a run
+    are kept as (frame_nr, n_missing) pairs. Runs in the acquisition process, the shared values
+    are only touched when a gap is found.
+    interval_tolerance: an interval longer than tolerance * the running mean interval, without
+    a frame id gap, is counted as a timestamp gap.
+    """
+    def __init__(self, max_gaps = 32, interval_tolerance = 1.8):
+        self.max_gaps = max_gaps
+        self.interval_tolerance = interval_tolerance
+        self.dropped_run = Value('i', 0)
+        self.dropped_total = Value('i', 0)
+        self.gaps_run = Value('i', 0)
+        self.interval_gaps_run = Value('i', 0)
+        self.gap_locations = Array('q', 2 * max_gaps)
+        self._last_id = None
+        self._last_timestamp = None
+        self._mean_interval = None
+
+    def reset_run(self):
+        self.dropped_run.value = 0
+        self.gaps_run.value = 0
+        self.interval_gaps_run.value = 0
+        self._last_id = None
+        self._last_timestamp = None
+        self._mean_interval = None
+
+    def update(self, frame_nr, frame_id, timestamp):
+        """Returns the number of frames missing before this one"""
+        n_missing = 0
+        if self._last_id is not None:
+            n_missing = max(0, frame_id - self._last_id - 1) # ids going back: counter reset, not a gap
+            dt = timestamp - self._last_timestamp
+            if dt > 0:
+                if n_missing == 0 and self._mean_interval is not None:
+                    if dt > self.interval_tolerance * self._mean_interval:
+                        self.interval_gaps_run.value += 1
+                        n_missing = int(round(dt / self._mean_interval)) - 1
+                if n_missing == 0:
+                    self._mean_interval = dt if self._mean_interval is None else 0.95 * self._mean_interval + 0.05 * dt
+            if n_missing > 0:
+                self._add_gap(frame_nr, n_missing)
+        self._last_id = frame_id
+        self._last_timestamp = timestamp
+        return n_missing
+
+    def _add_gap(self, frame_nr, n_missing):
+        i = self.gaps_run.value
+        if i < self.max_gaps:
+            self.gap_locations[2 * i] = frame_nr
+            self.gap_locations[2 * i + 1] = n_missing
+        self.gaps_run.value += 1
+        self.dropped_run.value += n_missing
+        self.dropped_total.value += n_missing
+
+    def get_gaps(self):
+        n = min(self.gaps_run.value, self.max_gaps)
+        return [(self.gap_locations[2 * i], self.gap_locations[2 * i + 1]) for i in range(n)]
+
+    def summary(self):
+        return {'dropped_frames': self.dropped_run.value,
+                'dropped_frames_total': self.dropped_total.value,
+                'n_gaps': self.gaps_run.value,
+                'n_timestamp_gaps': self.interval_gaps_run.value,
+                'first_gaps': [{'frame_nr': int(frame_nr), 'n_missing': int(n)} for frame_nr, n in self.get_gaps()]}
+
+def write_run_summary(filepath, summary):
+    """Saves the run summary as {filepath}_summary.json in the recording folder"""
+    fname = filepath + '_summary.json'
+    try:
+        with open(fname, 'w') as f:
+            json.dump(summary, f, indent = 4)
+    except Exception as e:
+        display(f'Could not write the run summary {fname}: {e}', level='error')
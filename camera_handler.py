@@ -6,10 +6,15 @@ import time
 import datetime
 from os.path import dirname, join
 import json
-from NeuCams.file_writer import BinaryWriter, TiffWriter, FFMPEGWriter, OpenCVWriter
+from NeuCams.file_writer import BinaryWriter, TiffWriter, FFMPEGWriter, OpenCVWriter, ZarrWriter, CompressedWriter, WriterCounters, WriterPool
 from NeuCams.utils import display, resolve_cam_id_by_serial
+from NeuCams.shared_buffers import LiveFrameBuffer
+from NeuCams.frame_metadata import FRAMES_DROPPED
+from NeuCams.acquisition_stats import FrameGapDetector, write_run_summary
+from NeuCams.clock_sync import ClockModel
+from NeuCams.frame_sync import SyncLog
+from NeuCams.process_placement import get_placement, apply_placement
 from importlib import import_module
-from NeuCams.cams.avt_cam import AVTCam
 # from cams.pco_cam import PCOCam
 # from cams.genicam import GenICam
 
@@ -38,12 +43,23 @@ class CameraFactory:
         return cam_class(cam_id=cam_id, params=params)
 
 class CameraHandler(Process):
+    control_timeout = 1.0 # s, max idle time between two checks of the events while waiting for a trigger
+    max_batch = 64 # max frames per cam.images() call, cam_dict 'max_batch' overrides it
+    clock_latch_interval = 1.0 # s, device clock latch interval, cam_dict 'clock_latch_interval' overrides it
+    n_handlers = 0 # handlers created in this process, for the automatic cpu placement
     
     def __init__(self, cam_dict, writer_dict):
         super().__init__()
         
         self.cam_dict = cam_dict
         self.writer_dict = writer_dict
+        self.max_batch = cam_dict.get('max_batch', self.max_batch)
+        self.clock_latch_interval = cam_dict.get('clock_latch_interval', self.clock_latch_interval)
+        self.placement, self.writer_placement = get_placement(cam_dict, CameraHandler.n_handlers,
+                                                              self._get_writer_class().uses_threads,
+                                                              writer_dict.get('writer_mode', 'process'),
+                                                              writer_dict.get('writer_pool', 0) > 1)
+        CameraHandler.n_handlers += 1
         
         self.close_event = Event()
         self.start_trigger = Event()
@@ -54,13 +70,17 @@ class CameraHandler(Process):
         
         self.is_acquisition_done = Event()
 
-        self.cam_param_InQ = Queue()
+        # control messages (start/stop wake-ups, param set/get), the handler blocks on this queue while idle.
+        # Unbounded: sending never blocks the GUI, even if the handler is stuck
+        self._control_queue = Queue()
         self.cam_param_OutQ = Queue()
+        # (frame_id, host timestamp, device timestamp) of the written frames, sent by the writer(s) to the frame sync coordinator
+        self.sync_log = SyncLog(n_writers = max(1, self.writer_dict.get('writer_pool', 0)))
         self.cam_param_get_flag = Event()
         
         self.handler_closed = Event()
         
-        self.img = None
+        self.live_buffer = None
         self.folder_path_array = Array('u',' ' * 1024) #can set folder
         self.filepath_array = Array('u',' ' * 1024) #filepath is readonly
         
@@ -68,9 +88,14 @@ class CameraHandler(Process):
         self.frame_nr = 0
         
         self.total_frames = Value('i', 0)
+        self.writer_counters = WriterCounters()
+        self.gap_detector = FrameGapDetector()
+        self.clock_model = ClockModel()
+        self._next_latch_ns = 0
         
         self.lastframeid = -1
         self.last_timestamp = 0
+        self.unsaved_frames = 0
         
         cam = self._open_cam()
         self.camera_connected = cam.is_connected()
@@ -100,18 +125,11 @@ class CameraHandler(Process):
                 display(f"ERROR: format (height, width, dtype[,n_chan]) needs to be set to init the framebuffer")
                 return
 
-            self.frame = Array(cdtype,np.zeros([height, width, n_chan],
-                                               dtype = dtype).flatten())
+            self.live_buffer = LiveFrameBuffer([height, width, n_chan], dtype)
             self.format = {'dtype':dtype, 'height':height,'width':width,'n_chan':n_chan,'cdtype':cdtype}
-            
-            self._init_buffer()
-            
-    def _init_buffer(self):
-        self.img = np.frombuffer(self.frame.get_obj(), dtype = self.format['cdtype'])\
-                        .reshape([self.format['height'], self.format['width'], self.format['n_chan']])
                         
     def run(self):
-        self._init_buffer()
+        apply_placement(f"{self.cam_dict.get('description', '')} camera", **self.placement)
         with self._open_cam() as cam:
             self.cam = cam
             with self._open_writer() as writer:
@@ -128,35 +146,44 @@ class CameraHandler(Process):
                             display(f'[{cam.name} {cam.cam_id}] filepath: {self.get_filepath()}')
                     while not self.stop_trigger.is_set():
                         self._process_queues()
-                        frame, metadata = cam.image()
-                        # Handle shared memory tuple from AVT
-                        if isinstance(frame, tuple) and len(frame) == 3 and isinstance(frame[0], str):
-                            shm_name, shape, dtype = frame
-                            frame, shm = AVTCam.frame_from_shm(shm_name, shape, dtype)
-                            frame = np.array(frame, copy=True)
-                            shm.close()
-                            shm.unlink()
-                        # Remove type/shape debug prints
-                        if frame is not None:
+                        frames, records = cam.images(self.max_batch)
+                        if frames is not None:
+                            self._batch_metadata(records, time.monotonic_ns())
                             if self.saving.is_set():
-                                writer.save(frame, metadata)
-                            self._update(frame,metadata)
-                        elif metadata == "stop":
+                                # frames of the batch that did not fit and older queued frames drop_oldest took out
+                                dropped = self.writer_counters.dropped.value
+                                writer.save_batch(frames, records)
+                                if self.writer_counters.dropped.value > dropped:
+                                    self._writer_backpressure(self.writer_counters.dropped.value - dropped)
+                            self._update_batch(frames, records)
+                        elif records == "stop":
                             self.stop_trigger.set()
                     display(f'[{cam.name} {cam.cam_id}] stop trigger set.')
                     self.close_run()
         self.handler_closed.set()
     
+    def _get_writer_class(self):
+        writers = {'opencv': OpenCVWriter, 'binary': BinaryWriter, 'tiff': TiffWriter, 'ffmpeg': FFMPEGWriter,
+                   'zarr': ZarrWriter, 'compressed': CompressedWriter}
+        return writers[self.writer_dict.get('recorder', 'opencv')]
+    
     def _open_writer(self):
-        writer_type = self.writer_dict.get('recorder', 'opencv')
-        writers = {'opencv': OpenCVWriter, 'binary': BinaryWriter, 'tiff': TiffWriter, 'ffmpeg': FFMPEGWriter} 
-        writer = writers[writer_type]
-        std_keys = ['frames_per_file'] #might be more later again
+        writer = self._get_writer_class()
+        std_keys = ['frames_per_file', 'transport', 'ring_slots', 'transport_check',
+                    'max_queue_frames', 'max_queue_bytes', 'overflow_policy', 'spill_folder', 'writer_mode',
+                    *writer.options]
         dict = {key: self.writer_dict[key] for key in self.writer_dict if key in std_keys}
+        dict['counters'] = self.writer_counters
+        dict['sync_log'] = self.sync_log
+        dict['frame_format'] = {key: self.format[key] for key in ['height', 'width', 'n_chan', 'dtype']}
         folder = join(self.writer_dict['data_folder'], self.cam_dict['description'], self.writer_dict['experiment_folder'])
         self.set_folder_path(folder)
         dict['filepath'] = self.get_new_filepath()
         dict['frame_rate'] = self.cam.params.get('frame_rate', None)
+        dict['placement'] = {'name': f"{self.cam_dict.get('description', '')} writer", **self.writer_placement}
+        n_workers = self.writer_dict.get('writer_pool', 0)
+        if n_workers > 1:
+            return WriterPool(writer, n_workers, **dict)
         return writer(**dict)
     
     def get_filepath(self):
@@ -201,15 +228,35 @@ class CameraHandler(Process):
         )
     
     def get_image(self):
-        return self.img
+        """Copy of the latest complete frame (None before the first frame)"""
+        img, _ = self.live_buffer.read()
+        return img
+    
+    def get_latest_image(self, last_seq = None):
+        """Returns (frame copy, seq), frame is None if nothing new since last_seq"""
+        return self.live_buffer.read(last_seq)
     
     def init_run(self):
         self.frame_nr = 0
         self.lastframeid = -1
+        self.unsaved_frames = 0
+        self.sync_log.dropped.value = 0
+        self.gap_detector.reset_run()
+        self.clock_model.reset()
+        self._next_latch_ns = 0
         self.writer.set_filepath(self.get_new_filepath())
+        self.writer_counters.reset_run() # after set_filepath, the writer finished the previous run
         self.camera_ready.set()
     
     def close_run(self):
+        if self.unsaved_frames > 0:
+            display(f'[{self.cam.name} {self.cam.cam_id}] {self.unsaved_frames} frames could not be saved (writer full).', level='warning')
+        self.writer.transport_monitor.report()
+        if self.gap_detector.dropped_run.value > 0:
+            display(f'[{self.cam.name} {self.cam.cam_id}] {self.gap_detector.dropped_run.value} dropped frames '
+                    f'in {self.gap_detector.gaps_run.value} gaps.', level='warning')
+        if self.saving.is_set() and self.frame_nr > 0:
+            write_run_summary(self.get_filepath(), self.get_run_summary())
         self.start_trigger.clear()
         self.is_acquisition_done.set()
         if self.saving.is_set():
@@ -218,21 +265,68 @@ class CameraHandler(Process):
             self.stop_trigger.clear()
         self.is_running.clear()
 
-    def _update(self, frame, metadata):
-        self._update_buffer(frame)
-        self.frame_nr += 1
-        self.total_frames.value += 1
-        frameID,timestamp = metadata[:2]
-        self.lastframeid = frameID
-        self.last_timestamp = timestamp
+    def get_run_summary(self):
+        return {'description': self.cam_dict.get('description', ''),
+                'run_nr': self.run_nr,
+                'n_frames': self.frame_nr,
+                'unsaved_frames': self.unsaved_frames,
+                'sync_dropped': self.sync_log.dropped.value,
+                'writer': self.writer_counters.as_dict(),
+                'driver': self.cam.get_acquisition_stats(),
+                'clock': self.clock_model.summary(),
+                **self.gap_detector.summary()}
+    
+    def _batch_metadata(self, records, host_time_ns):
+        """Fills in the records of a batch from cam.images() (in place)"""
+        records['host_time_ns'] = host_time_ns
+        records['run_nr'] = self.run_nr
+        for i, (frame_id, timestamp) in enumerate(zip(records['frame_id'].tolist(), records['timestamp'].tolist())):
+            if self.gap_detector.update(self.frame_nr + i, frame_id, timestamp) > 0:
+                records['flags'][i] |= FRAMES_DROPPED
+        self._map_timestamps(records, host_time_ns)
+        return records
+    
+    def _map_timestamps(self, records, host_time_ns):
+        """Latches the device clock every clock_latch_interval and maps the batch timestamps to host time.
+        Cameras without a latch use the arrival time of the last frame of the batch."""
+        if host_time_ns >= self._next_latch_ns:
+            try:
+                latch = self.cam.latch_timestamp()
+            except Exception as e:
+                display(f'[{self.cam.name} {self.cam.cam_id}] clock latch failed: {e}', level='warning')
+                latch = None
+            if latch is None:
+                self.clock_model.source = 'arrival'
+                latch = (records['timestamp'][-1], host_time_ns)
+            self.clock_model.add_latch(*latch)
+            self._next_latch_ns = host_time_ns + int(self.clock_latch_interval * 1e9)
+        records['host_timestamp_ns'] = self.clock_model.to_host(records['timestamp'])
+    
+    def _update_batch(self, frames, records):
+        """live view gets the last frame of the batch"""
+        self._update_buffer(frames[-1])
+        n = len(frames)
+        self.frame_nr += n
+        self.total_frames.value += n
+        self.lastframeid = int(records['frame_id'][-1])
+        self.last_timestamp = float(records['timestamp'][-1])
+    
+    def _writer_backpressure(self, n = 1):
+        self.unsaved_frames += n
+        if self.unsaved_frames == n:
+            display(f'[{self.cam.name} {self.cam.cam_id}] writer is falling behind, frames are not saved.', level='warning')
     
     def _update_buffer(self,frame):
-        self.img[:] = np.reshape(frame,self.img.shape)[:]
+        self.live_buffer.write(frame)
         
     def wait_for_trigger(self):
         while not self.start_trigger.is_set() and not self.stop_trigger.is_set():
-            self._process_queues()
-            time.sleep(0.001) # limits resolution to 1 ms
+            # start_acquisition/stop_acquisition send a message after setting the event
+            try:
+                message = self._control_queue.get(timeout = self.control_timeout)
+            except queue.Empty:
+                continue
+            self._process_params(message)
         self.cam.apply_params()
         self.is_running.set()
         self.camera_ready.clear()
@@ -271,49 +365,54 @@ class CameraHandler(Process):
     def _process_queues(self):
         self._process_params()
 
-    def _process_params(self):
-        # Handle all pending requests in the queue
+    def _process_params(self, message = None):
+        # Handle all pending requests in the queue (after message, if one was already taken)
         params_to_set = False
-        while not self.cam_param_InQ.empty():
-            try:
-                message = self.cam_param_InQ.get_nowait()
-                if not isinstance(message, tuple) or not message:
-                    continue
+        while True:
+            if message is None:
+                try:
+                    message = self._control_queue.get_nowait()
+                except queue.Empty:
+                    break
+            message, pending = None, message
+            if not isinstance(pending, tuple) or not pending:
+                continue
 
-                command = message[0]
-                if command == 'get':
-                    # Always clear previous params from the queue
-                    clear_queue(self.cam_param_OutQ)
-                    # Send back a copy of all exposed params
-                    for param, val in self.cam.params.items():
-                        if param in self.cam.exposed_params:
-                            self.cam_param_OutQ.put((param, val))
-                    self.cam_param_get_flag.set()
+            command = pending[0]
+            if command == 'get':
+                # Always clear previous params from the queue
+                clear_queue(self.cam_param_OutQ)
+                # Send back a copy of all exposed params
+                for param, val in self.cam.params.items():
+                    if param in self.cam.exposed_params:
+                        self.cam_param_OutQ.put((param, val))
+                self.cam_param_get_flag.set()
 
-                elif command == 'set' and len(message) == 3:
-                    _, param, val = message
-                    self.cam.set_param(param, val)
-                    params_to_set = True
-
-            except queue.Empty:
-                break  # No more messages
+            elif command == 'set' and len(pending) == 3:
+                _, param, val = pending
+                self.cam.set_param(param, val)
+                params_to_set = True
         
         # If any 'set' commands were processed, apply them in one batch
         if params_to_set:
             self.cam.apply_params()
 
+    def _send_control(self, message):
+        """Queues a control message, never blocks. Dropped if the handler is closed or dead."""
+        if self.handler_closed.is_set() or self.exitcode is not None:
+            return
+        # a stuck handler must not keep this process from exiting
+        self._control_queue.cancel_join_thread()
+        self._control_queue.put(message)
+
     def set_cam_param(self, param : str, val):
-        """Puts a ('set', param, value) command on the input queue."""
-        try:
-            # Use a tuple to be consistent with the 'get' command
-            self.cam_param_InQ.put(('set', param, val))
-        except queue.Full:
-            display(f"Warning: could not set cam param {param}, queue is full",
-                    level='warning')
+        """Sends a ('set', param, value) command to the handler."""
+        # Use a tuple to be consistent with the 'get' command
+        self._send_control(('set', param, val))
 
     def query_cam_params(self):
         # self.cam_param_OutQ.put(None) # Not needed with clear_queue
-        self.cam_param_InQ.put(('get',))
+        self._send_control(('get',))
 
     def get_cam_params(self, timeout=0.2):
         """
@@ -341,12 +440,14 @@ class CameraHandler(Process):
         if self.camera_ready.is_set():
             self.is_acquisition_done.clear()
             self.start_trigger.set()
+            self._send_control(('start',))
             return True
         print(f"Could not start acquisition, camera {self.cam_dict['description']} not ready", flush=True)
         return False
         
     def stop_acquisition(self):
         self.stop_trigger.set()
+        self._send_control(('stop',))
 
     def close(self):
         self.close_event.set()
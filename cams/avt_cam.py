@@ -1,13 +1,15 @@
 # avt_cam.py  –  Vimba X / vmbpy-compatible
+import queue
+import time
 import numpy as np
-from multiprocessing import shared_memory
 from vmbpy import (
     VmbSystem,
-    Frame, Camera, PixelFormat,
+    Frame, FrameStatus, Camera, PixelFormat,
     VmbFeatureError, VmbTimeout,
 )
 from .generic_cam import GenericCam
 from NeuCams.utils import display
+from NeuCams.frame_metadata import FRAME_INCOMPLETE
 
 
 # ----------------------------------------------------------------------
@@ -21,23 +23,6 @@ def _set(cam: Camera, feat_name: str, value):
 # ----------------------------------------------------------------------
 
 
-def debug_pickle(obj, prefix=''):
-    import pickle, collections.abc
-    try:
-        pickle.dumps(obj)
-        # print(prefix, '✅ picklable', type(obj))
-        pass
-    except Exception as e:
-        # print(prefix, '❌ NOT picklable', type(obj), '→', e)
-        if isinstance(obj, (list, tuple, set)):
-            for i, item in enumerate(obj):
-                debug_pickle(item, prefix + f'  [{i}] ')
-        elif isinstance(obj, dict):
-            for k, v in obj.items():
-                debug_pickle(k, prefix + '  {key} ')
-                debug_pickle(obj[k], prefix + f'  {k}: ')
-
-
 def AVT_get_ids():
     """Return ([ids], [pretty strings]) for all connected Allied Vision cams."""
     with VmbSystem.get_instance() as vmb:
@@ -77,11 +62,16 @@ class AVTCam(GenericCam):
             "triggerSource": "Line1",
             "triggerMode": "LevelHigh",
             "triggerSelector": "FrameStart",
+            "ring_slots": 16,                # preallocated frame slots
+            "acquisition": "streaming",      # 'streaming' (callback, n_frame_buffers announced) or 'sync'
+            "n_frame_buffers": 10,           # buffers announced to the driver when streaming
         }
         self.exposed_params = [
             "frame_rate", "gain", "exposure", "gain_auto",
             "triggered", "acquisition_mode", "n_frames",
         ]
+        if "nFrameBuffers" in self.params:  # legacy config key
+            self.params.setdefault("n_frame_buffers", self.params.pop("nFrameBuffers"))
         self.params = {**default_params, **self.params}
 
         default_format = {"dtype": np.uint8}
@@ -89,9 +79,14 @@ class AVTCam(GenericCam):
 
         # internal state
         self.cam_handle = None
+        self.tick_frequency = 1e9          # device timestamp ticks per s
+        self.latch_features = None
         self.vimba = None
         self.frame_generator = None
         self.is_recording = False
+        self.is_streaming = False
+        self._last_stream_id = None
+        self.stream_stats = {}
 
     # ------------------------------------------------------------------
     # connection helpers
@@ -124,6 +119,8 @@ class AVTCam(GenericCam):
 
         self.cam_handle.__enter__()
         self.apply_params()
+        self._read_format()
+        self._read_clock()
         self._record()
         self._init_format()
         return self
@@ -134,6 +131,7 @@ class AVTCam(GenericCam):
                 self.stop()
             if self.cam_handle:
                 self.cam_handle.__exit__(exc_type, exc_val, exc_tb)
+            self._close_frame_ring()
         finally:
             if self.vimba:
                 self.vimba.__exit__(exc_type, exc_val, exc_tb)
@@ -174,14 +172,57 @@ class AVTCam(GenericCam):
         if resume_recording:
             self._record()
 
+    def _read_format(self):
+        """Frame geometry from the camera features, needed to size the frame ring."""
+        try:
+            self.format["height"] = int(self.cam_handle.Height.get())
+            self.format["width"] = int(self.cam_handle.Width.get())
+            self.format.setdefault("n_chan", 1)
+        except (AttributeError, VmbFeatureError) as err:
+            display(f"Could not read frame size: {err}", level="warning")
+
+    def _read_clock(self):
+        """Device clock: SFNC TimestampLatch (ns) or the GigE GevTimestamp features (ticks)."""
+        for latch, value, frequency in [("TimestampLatch", "TimestampLatchValue", None),
+                                        ("GevTimestampControlLatch", "GevTimestampValue", "GevTimestampTickFrequency")]:
+            try:
+                self.latch_features = (getattr(self.cam_handle, latch), getattr(self.cam_handle, value))
+                self.tick_frequency = float(getattr(self.cam_handle, frequency).get()) if frequency else 1e9
+                return
+            except (AttributeError, VmbFeatureError):
+                continue
+        self.latch_features = None
+        display("No timestamp latch, frame arrival times are used for the clock mapping.", level="warning")
+
+    def latch_timestamp(self):
+        if self.latch_features is None:
+            return None
+        latch, value = self.latch_features
+        t0 = time.monotonic_ns()
+        latch.run()
+        t1 = time.monotonic_ns()
+        return value.get() / self.tick_frequency, (t0 + t1) // 2
+
     # ------------------------------------------------------------------
     # acquisition
     # ------------------------------------------------------------------
     def _record(self):
-        """Create a blocking generator that yields (shm.name, shape, dtype, meta)."""
+        """Start acquisition: callback streaming into the frame ring, or the blocking generator."""
         self.is_recording = True
-
+        if "height" in self.format and "width" in self.format:
+            self._open_frame_ring(self.params["ring_slots"])
+        if self.params["acquisition"] == "streaming":
+            if self.frame_ring is not None:
+                self._start_streaming()
+                return
+            display("Frame size unknown, AVT streaming not possible, using synchronous acquisition.",
+                    level="warning")
+        self._record_sync()
+
+    def _record_sync(self):
+        """Create a blocking generator that fills ring slots in place and yields (slot, meta)."""
         def _gen():
+            slot = 0
             while self.is_recording:
                 try:
                     if self.cam_handle is not None:
@@ -193,26 +234,72 @@ class AVTCam(GenericCam):
                     continue
                 if frame is not None:
                     arr = frame.as_numpy_ndarray()
-                    # Allocate shared memory for the frame
-                    shm = shared_memory.SharedMemory(create=True, size=arr.nbytes)
-                    shm_arr = np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)
-                    shm_arr[:] = arr  # Copy frame data into shared memory
-                    meta = (frame.get_id(), frame.get_timestamp())
-                    # Yield the shared memory name, shape, dtype, and meta
-                    yield (shm.name, arr.shape, str(arr.dtype), meta)
+                    if self.frame_ring is None or not self.frame_ring.matches(arr.shape, arr.dtype):
+                        # format changed (or unknown) - only happens once per stream
+                        self.format["height"], self.format["width"] = arr.shape[:2]
+                        self.format["n_chan"] = arr.shape[2] if arr.ndim == 3 else 1
+                        self._open_frame_ring(self.params["ring_slots"], shape=arr.shape)
+                    self.frame_ring[slot][:] = arr
+                    flags = 0 if frame.get_status() == FrameStatus.Complete else FRAME_INCOMPLETE
+                    meta = (frame.get_id(), frame.get_timestamp() / self.tick_frequency, flags)
+                    yield slot, meta
+                    slot = (slot + 1) % len(self.frame_ring)
                 else:
                     yield None, "no frame"
         self.frame_generator = _gen()
 
-    # Helper for consumer to reconstruct frame from shared memory
-    @staticmethod
-    def frame_from_shm(shm_name, shape, dtype):
-        shm = shared_memory.SharedMemory(name=shm_name)
-        arr = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
-        return arr, shm
+    def _start_streaming(self):
+        """Driver side streaming with n_frame_buffers announced buffers.
+        The callback copies each frame into a free ring slot and hands the slot over to image();
+        a slot is free again once the next image() call is made."""
+        self._init_slot_pool()
+        self._last_stream_id = None
+        self.stream_stats = {"frames": 0, "incomplete": 0, "missed": 0, "ring_overruns": 0}
+        self.cam_handle.start_streaming(handler=self._frame_handler,
+                                        buffer_count=self.params["n_frame_buffers"])
+        self.is_streaming = True
+
+    def _stop_streaming(self):
+        if self.is_streaming:
+            self.cam_handle.stop_streaming()
+            self.is_streaming = False
+            s = self.stream_stats
+            display(f"AVT streaming: {s['frames']} frames, {s['incomplete']} incomplete, "
+                    f"{s['missed']} missed by the driver (buffer underrun), "
+                    f"{s['ring_overruns']} lost on a full frame ring.")
+
+    def _frame_handler(self, cam, *args):
+        """vmbpy streaming callback (cam, [stream,] frame), runs in the driver thread"""
+        frame = args[-1]
+        try:
+            stats = self.stream_stats
+            frame_id = frame.get_id()
+            stats["frames"] += 1
+            if self._last_stream_id is not None and frame_id > self._last_stream_id + 1:
+                stats["missed"] += frame_id - self._last_stream_id - 1
+            self._last_stream_id = frame_id
+            flags = 0
+            if frame.get_status() != FrameStatus.Complete:
+                stats["incomplete"] += 1
+                flags = FRAME_INCOMPLETE
+            try:
+                slot = self._free_slots.get_nowait()
+            except queue.Empty:
+                stats["ring_overruns"] += 1
+                return
+            self.frame_ring[slot][:] = np.reshape(frame.as_numpy_ndarray(), self.frame_ring.shape)
+            self._ready_slots.put((slot, (frame_id, frame.get_timestamp() / self.tick_frequency, flags)))
+        except Exception as err:
+            display(f"AVT frame callback error: {err}", level="error")
+        finally:
+            cam.queue_frame(frame)
+
+    def get_acquisition_stats(self):
+        return dict(self.stream_stats)
 
     def stop(self):
         self.is_recording = False
+        self._stop_streaming()
         display("AVT cam stopped.")
 
     # ------------------------------------------------------------------
@@ -222,6 +309,9 @@ class AVTCam(GenericCam):
         if not self.is_recording:
             display("image() called while not recording.", level="warning")
             return None, "not recording"
+        if self.is_streaming:
+            # view on the ring slot, valid until the next image() call
+            return self._next_ready_slot(self.timeout / 1000)
         # Ensure frame_generator is initialized and is a generator
         if self.frame_generator is None:
             self._record()
@@ -229,39 +319,21 @@ class AVTCam(GenericCam):
             display("frame_generator is not a generator object.", level="error")
             return None, "generator error"
         try:
-            result = next(self.frame_generator)
-            # Handle shared memory tuple
-            if isinstance(result, tuple) and len(result) == 4 and isinstance(result[0], str):
-                shm_name, shape, dtype, meta = result
-                img, shm = self.frame_from_shm(shm_name, shape, dtype)
-                # Optionally, copy to detach from shared memory and clean up
-                img_copy = np.array(img, copy=True)
-                shm.close()
-                shm.unlink()
-                return img_copy, meta
-            else:
-                img, meta = result
-                return img, meta
+            slot, meta = next(self.frame_generator)
+            if slot is None:
+                return None, meta
+            # view on the ring slot, valid until the ring wraps around
+            return self.frame_ring[slot], meta
         except StopIteration:
             return None, "stop"
         except Exception as err:
             display(f"Error fetching image: {err}", level="error")
             return None, "error"
 
+    def images(self, max_n = 64, timeout = None):
+        if self.is_recording and self.is_streaming:
+            return self._next_ready_batch(max_n, self.timeout / 1000 if timeout is None else timeout)
+        return super().images(max_n, timeout)
+
     # alias for GenericCam compatibility
     close = stop
-
-    def _init_format(self):
-        frame, _ = self.image()
-        # Handle shared memory tuple from AVT
-        if isinstance(frame, tuple) and len(frame) == 3 and isinstance(frame[0], str):
-            shm_name, shape, dtype = frame
-            frame, shm = AVTCam.frame_from_shm(shm_name, shape, dtype)
-            frame = np.array(frame, copy=True)
-            shm.close()
-            shm.unlink()
-        if frame is not None:
-            self.format['height'] = frame.shape[0]
-            self.format['width'] = frame.shape[1]
-            self.format['n_chan'] = frame.shape[2] if frame.ndim == 3 else 1
-            display(f"{self.name} - size: {self.format['height']} x {self.format['width']}")
@@ -3,9 +3,12 @@ Camera classes for behavioral monitoring and single photon imaging.
 Creates separate processes for acquisition and queues frames"""
 import time
 import ctypes
+import queue
 
 import numpy as np
 from NeuCams.utils import display
+from NeuCams.shared_buffers import SharedFrameRing
+from NeuCams.frame_metadata import make_metadata_records
 
 
 class GenericCam:
@@ -24,6 +27,8 @@ class GenericCam:
         self.is_recording = False
         
         self.exposed_params = []
+        
+        self.frame_ring = None
     
     def _init_format(self):
         frame, _ = self.image()
@@ -33,6 +38,69 @@ class GenericCam:
             self.format['n_chan'] = frame.shape[2] if frame.ndim == 3 else 1
             display(f"{self.name} - size: {self.format['height']} x {self.format['width']}")
     
+    def _open_frame_ring(self, n_slots, shape = None):
+        '''(re)allocates the frame ring from self.format, kept as long as the format does not change'''
+        if shape is None:
+            shape = (self.format['height'], self.format['width'], self.format.get('n_chan', 1))
+        dtype = self.format.get('dtype', np.uint8)
+        if self.frame_ring is not None:
+            if self.frame_ring.matches(shape, dtype) and len(self.frame_ring) == n_slots:
+                return self.frame_ring
+            self._close_frame_ring()
+        self.frame_ring = SharedFrameRing(n_slots, shape, dtype, private = True)
+        return self.frame_ring
+    
+    def _close_frame_ring(self):
+        if self.frame_ring is not None:
+            self.frame_ring.close()
+            self.frame_ring = None
+    
+    def _init_slot_pool(self):
+        '''ring slots handed from an acquisition thread to image():
+        free -> filled by the thread -> ready -> held by the caller until its next image() call'''
+        self._free_slots = queue.SimpleQueue()
+        for slot in range(len(self.frame_ring)):
+            self._free_slots.put(slot)
+        self._ready_slots = queue.Queue()
+        self._held_slot = None
+    
+    def _next_ready_slot(self, timeout):
+        '''returns (view on the next filled slot, meta) or (None, "timeout")'''
+        if self._held_slot is not None:
+            self._free_slots.put(self._held_slot)
+            self._held_slot = None
+        try:
+            slot, meta = self._ready_slots.get(timeout = timeout)
+        except queue.Empty:
+            return None, 'timeout'
+        if slot is None: # end of acquisition marker (None, status)
+            return None, meta
+        self._held_slot = slot
+        return self.frame_ring[slot], meta
+    
+    def _next_ready_batch(self, max_n, timeout):
+        '''copies all filled slots (at most max_n) into one array and frees them, returns (frames, records) or (None, status)'''
+        if self._held_slot is not None:
+            self._free_slots.put(self._held_slot)
+            self._held_slot = None
+        ready = []
+        try:
+            ready.append(self._ready_slots.get(timeout = timeout))
+            while len(ready) < max_n and ready[-1][0] is not None:
+                ready.append(self._ready_slots.get_nowait())
+        except queue.Empty:
+            if not ready:
+                return None, 'timeout'
+        if ready[-1][0] is None: # end of acquisition marker (None, status)
+            if len(ready) == 1:
+                return ready[0]
+            self._ready_slots.put(ready.pop()) # returned on the next call
+        slots = [slot for slot, _ in ready]
+        frames = self.frame_ring.frames[slots]
+        for slot in slots:
+            self._free_slots.put(slot)
+        return frames, make_metadata_records([meta for _, meta in ready])
+    
     def is_connected(self):
         pass
         
@@ -71,6 +139,23 @@ class GenericCam:
     def get_health_status(self):
         pass
     
+    def latch_timestamp(self):
+        '''latches the device clock: (device time in s, time.monotonic_ns()) or None if the camera has no latch'''
+        return None
+    
+    def get_acquisition_stats(self):
+        '''driver side acquisition statistics (buffer underruns...), added to the run summary'''
+        return {}
+    
     def image(self):
         pass
+    
+    def images(self, max_n = 64, timeout = None):
+        '''all frames ready now (at most max_n): (n, H, W[, n_chan]) array and FRAME_METADATA_DTYPE records,
+        (None, status) like image() when there is none.
+        Drivers that can drain several buffers at once override it, this one wraps image()'''
+        frame, meta = self.image()
+        if frame is None:
+            return None, meta
+        return frame[np.newaxis], make_metadata_records([meta])
 
@@ -1,10 +1,14 @@
 from os import path
 import time
+import queue
+import threading
 import numpy as np
 try:
     from harvesters.core import Harvester
+    from genicam.gentl import TimeoutException
 except ImportError:
     Harvester = None
+    TimeoutException = TimeoutError
 from .generic_cam import GenericCam
 from NeuCams.utils import display
 
@@ -51,11 +55,20 @@ class GenICam(GenericCam):
                 # Default to first serial number
                 cam_id = getattr(self.h.device_info_list[0], 'serial_number', None)
         super().__init__(name = 'GenICam', cam_id = cam_id, params = params, format = format)
-        default_params = {'exposure':29000, 'frame_rate':30,'gain':8, 'gain_auto': False, 'acquisition_mode': 'Continuous', 'n_frames': 1, 'triggered': False}
+        default_params = {'exposure':29000, 'frame_rate':30,'gain':8, 'gain_auto': False, 'acquisition_mode': 'Continuous', 'n_frames': 1, 'triggered': False,
+                          'num_buffers': 16,         # GenTL buffers announced to the producer
+                          'fetch_timeout': 0.5,      # s
+                          'background_fetch': True,  # fetch in a thread into the frame ring
+                          'ring_slots': 16}
         self.exposed_params = ['frame_rate', 'gain', 'exposure', 'gain_auto', 'triggered', 'acquisition_mode', 'n_frames']
         self.params = {**default_params, **self.params}
         default_format = {'dtype': np.uint8}
         self.format = {**default_format, **self.format}
+        self.fetch_thread = None
+        self.is_fetching = threading.Event()
+        self.tick_frequency = 1e9
+        self.latch_features = None
+        self.stream_stats = {}
 
     def is_connected(self):
         cam_name = getattr(self, 'name', self.params.get('name', 'unknown')) if hasattr(self, 'params') else getattr(self, 'name', 'unknown')
@@ -91,20 +104,25 @@ class GenICam(GenericCam):
             return self
         self.cam_handle = self.h.create(cam_index)
         self.cam_handle.__enter__()
-        self.cam_handle.num_buffers = 2
+        self.cam_handle.num_buffers = self.params['num_buffers']
         self.features = self.cam_handle.remote_device.node_map
         self.apply_params()
+        self._read_format()
+        self._read_clock()
         self._record()
         self._init_format()
         return self
         
     def __exit__(self, exc_type, exc_value, exc_traceback):
         if hasattr(self, 'cam_handle') and self.cam_handle is not None:
+            if self.is_recording:
+                self.stop()
             self.cam_handle.__exit__(exc_type, exc_value, exc_traceback)
             display('GenICam cam exited.')
         else:
             display('GenICam cam __exit__ called, but camera was never opened.', level='warning')
         self.close()
+        self._close_frame_ring()
         return True
 
     def close(self):
@@ -149,53 +167,180 @@ class GenICam(GenericCam):
                 pass
         return features_str
 
-    def get_frame_generator(self, n_frames = None, timeout_ms = 0):
+    def _read_format(self):
+        """frame size from the node map, needed to size the frame ring"""
+        try:
+            self.format['height'] = int(self.features.Height.value)
+            self.format['width'] = int(self.features.Width.value)
+            self.format.setdefault('n_chan', 1)
+        except Exception as e:
+            display(f'GenICam - could not read the frame size: {e}', level='warning')
+
+    def _read_clock(self):
+        """device clock: SFNC TimestampLatch (ns) or the GigE Vision GevTimestamp features (ticks)"""
+        for latch, value, frequency in [('TimestampLatch', 'TimestampLatchValue', None),
+                                        ('GevTimestampControlLatch', 'GevTimestampValue', 'GevTimestampTickFrequency')]:
+            try:
+                self.latch_features = (getattr(self.features, latch), getattr(self.features, value))
+                self.tick_frequency = float(getattr(self.features, frequency).value) if frequency else 1e9
+                return
+            except Exception:
+                continue
+        self.latch_features = None
+        display('GenICam - no timestamp latch, frame arrival times are used for the clock mapping.', level='warning')
+
+    def latch_timestamp(self):
+        if self.latch_features is None:
+            return None
+        latch, value = self.latch_features
+        t0 = time.monotonic_ns()
+        latch.execute()
+        t1 = time.monotonic_ns()
+        return value.value / self.tick_frequency, (t0 + t1) // 2
+
+    def _buffer_timestamp(self, buffer):
+        """device timestamp of the buffer in s"""
+        try:
+            return buffer.timestamp_ns * 1e-9
+        except Exception:
+            return buffer.timestamp / self.tick_frequency
+
+    def _buffer_frame_id(self, buffer, idx):
+        """hardware frame id of the buffer (GenTL BUFFER_INFO_FRAMEID), idx if the producer has none"""
+        for source in (buffer, getattr(buffer, 'module', None)):
+            try:
+                return int(source.frame_id)
+            except Exception:
+                continue
+        return idx
+
+    def _fetch_error(self, e):
+        """counts a failed fetch that was not a timeout, logs the first one"""
+        self.stream_stats['fetch_errors'] = self.stream_stats.get('fetch_errors', 0) + 1
+        if self.stream_stats['fetch_errors'] == 1:
+            display(f'GenICam - fetch failed: {e}', level='error')
+
+    def _fetch_into(self, slot, timeout, idx):
+        """fetches one buffer and copies it straight into a ring slot,
+        returns (frame_id, timestamp) or None on timeout/error"""
+        try:
+            with self.cam_handle.fetch(timeout = timeout) as buffer:
+                component = buffer.payload.components[0]
+                data = component.data.reshape(component.height, component.width)
+                if data.shape != self.frame_ring.shape[:2]:
+                    if self.fetch_thread is not None:
+                        display('GenICam - frame size changed while fetching in the background.', level='error')
+                        return None
+                    self.format['height'], self.format['width'] = data.shape
+                    self._open_frame_ring(self.params['ring_slots'])
+                np.copyto(self.frame_ring[slot].reshape(data.shape), data)
+                metadata = (self._buffer_frame_id(buffer, idx), self._buffer_timestamp(buffer))
+        except TimeoutException:
+            self.stream_stats['fetch_timeouts'] = self.stream_stats.get('fetch_timeouts', 0) + 1
+            return None
+        except Exception as e: # buffer exceptions should not kill the acquisition
+            self._fetch_error(e)
+            return None
+        return metadata
+
+    def get_frame_generator(self, n_frames = None, timeout = 0):
+        """fetches in the calling thread, yields (slot or None, frame_id, timestamp)"""
         idx = 0
+        slot = 0
         while (n_frames is None) or idx < n_frames:
+            metadata = self._fetch_into(slot, timeout, idx)
+            if metadata is None:
+                yield None, idx, None
+                continue
+            yield (slot, *metadata)
+            slot = (slot + 1) % len(self.frame_ring)
+            idx += 1
+
+    def _fetch_loop(self, n_frames = None):
+        """background fetch thread: keeps the GenTL buffers cycling and fills free ring slots"""
+        idx = 0
+        stats = self.stream_stats
+        while self.is_fetching.is_set() and ((n_frames is None) or idx < n_frames):
             try:
-                with self.cam_handle.fetch(timeout = timeout_ms) as buffer:
-                    payload = buffer.payload
-                    timestamp = buffer.timestamp
-                    component = payload.components[0]
-                    to_print = component.data.shape
-                    _2d = component.data.reshape(component.height, component.width)
-                    frame = np.copy(_2d)
-            except Exception: # buffer exceptions should not kill the generator
-                frame = np.array([])
-            yield frame, idx, time.time() - self.t_start
+                slot = self._free_slots.get_nowait()
+            except queue.Empty:
+                # image() is behind: fetch anyway so the producer does not run out of buffers
+                slot = None
+            if slot is None:
+                try:
+                    with self.cam_handle.fetch(timeout = self.params['fetch_timeout']):
+                        stats['ring_overruns'] += 1
+                        idx += 1
+                except TimeoutException:
+                    stats['fetch_timeouts'] += 1
+                except Exception as e:
+                    self._fetch_error(e)
+                continue
+            metadata = self._fetch_into(slot, self.params['fetch_timeout'], idx)
+            if metadata is None:
+                self._free_slots.put(slot)
+                continue
+            stats['frames'] += 1
+            self._ready_slots.put((slot, metadata))
             idx += 1
-            
+        if self.is_fetching.is_set(): # n_frames reached
+            self._ready_slots.put((None, 'stop'))
+
     def _record(self):
         if not hasattr(self, 'cam_handle') or self.cam_handle is None:
             display('GenICam cam _record() called, but camera was never opened.', level='warning')
             return
+        self._open_frame_ring(self.params['ring_slots'])
+        self.stream_stats = {'frames': 0, 'ring_overruns': 0, 'fetch_timeouts': 0, 'fetch_errors': 0}
         self.cam_handle.start() # it was self.cam_handle.start(run_in_background = True)
         limit = self.params['n_frames'] if self.params['acquisition_mode'] == "MultiFrame" else None
-        self.t_start = time.time()
-        self.frame_generator = self.get_frame_generator(n_frames = limit, timeout_ms = self.timeout//1000)
+        if self.params['background_fetch']:
+            self._init_slot_pool()
+            self.is_fetching.set()
+            self.fetch_thread = threading.Thread(target = self._fetch_loop, args = (limit,), daemon = True)
+            self.fetch_thread.start()
+        else:
+            self.frame_generator = self.get_frame_generator(n_frames = limit, timeout = self.params['fetch_timeout'])
         self.is_recording = True
         
     def stop(self):
         if not hasattr(self, 'cam_handle') or self.cam_handle is None:
             display('GenICam cam stop() called, but camera was never opened.', level='warning')
             return
+        if self.fetch_thread is not None:
+            self.is_fetching.clear()
+            self.fetch_thread.join()
+            self.fetch_thread = None
         self.cam_handle.stop()
         self.is_recording = False
-        display('GenICam cam stopped.')
+        s = self.stream_stats
+        display(f"GenICam cam stopped ({s.get('frames', 0)} frames fetched in the background, "
+                f"{s.get('ring_overruns', 0)} lost on a full frame ring, {s.get('fetch_timeouts', 0)} fetch timeouts, "
+                f"{s.get('fetch_errors', 0)} fetch errors).")
+    
+    def get_acquisition_stats(self):
+        return dict(self.stream_stats)
         
     def image(self):
         if not hasattr(self, 'cam_handle') or self.cam_handle is None:
             display('GenICam cam image() called, but camera was never opened.', level='warning')
             return None, 'not recording'
         if self.is_recording:
+            if self.fetch_thread is not None:
+                return self._next_ready_slot(self.params['fetch_timeout'])
             try:
-                frame, frame_id, time_stamp = next(self.frame_generator)
+                slot, frame_id, time_stamp = next(self.frame_generator)
             except StopIteration:
                 return None, "stop"
             except Exception:
                 return None, 'error'
-            if frame.shape[0] == 0:
+            if slot is None:
                 return None, "timeout"
-            return frame, (frame_id, time_stamp)
+            # view on the ring slot, valid until the ring wraps around
+            return self.frame_ring[slot], (frame_id, time_stamp)
         return None, 'not recording'
-      
\ No newline at end of file
+
+    def images(self, max_n = 64, timeout = None):
+        if self.is_recording and self.fetch_thread is not None:
+            return self._next_ready_batch(max_n, self.params['fetch_timeout'] if timeout is None else timeout)
+        return super().images(max_n, timeout)
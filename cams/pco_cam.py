@@ -1,12 +1,15 @@
 """pco_cam.py
 """
 import time
+import calendar
+from collections import deque
 import numpy as np
 try:
     import pco
 except ImportError:
     pco = None
 from NeuCams.cams.generic_cam import GenericCam
+from NeuCams.frame_metadata import make_metadata_records
 from NeuCams.utils import display
 
 class PCOCam(GenericCam):
@@ -21,8 +24,11 @@ class PCOCam(GenericCam):
         default_params = {'exposure':15000, 
                           'triggered':False,
                           'triggerSource': 'external exposure start & software trigger',
-                          'binning': 1
-                          #'poll_timeout':1, 
+                          'binning': 1,
+                          'acquisition': 'bulk',   # 'bulk': drain every image in the FIFO per call, 'single': one image per call
+                          'fifo_size': 100,        # images allocated by the recorder (>= 4)
+                          'timestamp': 'binary',   # camera stamps counter and time into the first 14 pixels
+                          'poll_timeout': 1,       # s, image() returns 'timeout' after waiting this long
                           }
                           
                             # 'triggerSource' options
@@ -41,6 +47,8 @@ class PCOCam(GenericCam):
         
         default_format = {'dtype': np.uint16}
         self.format = {**default_format, **self.format}
+        self.pending = deque()
+        self.fifo_stats = {}
     
     def is_connected(self):
         cam_name = getattr(self, 'name', self.params.get('name', 'unknown')) if hasattr(self, 'params') else getattr(self, 'name', 'unknown')
@@ -95,6 +103,8 @@ class PCOCam(GenericCam):
         adjusted_params['exposure time'] = adjusted_params.pop('exposure')/1_000_000
         adjusted_params['trigger'] = adjusted_params['triggerSource'] if self.params['triggered'] else 'auto sequence'
         adjusted_params['binning'] = (adjusted_params['binning'],adjusted_params['binning'])
+        for key in ['acquisition', 'fifo_size', 'poll_timeout']:
+            adjusted_params.pop(key)
         self.cam_handle.configuration = adjusted_params
         display(f'PCO - configuration: {self.cam_handle.configuration}')
         if resume_recording:
@@ -104,14 +114,19 @@ class PCOCam(GenericCam):
         if not hasattr(self, 'cam_handle') or self.cam_handle is None:
             display('PCO cam _record() called, but camera was never opened.', level='warning')
             return
-        self.cam_handle.record(number_of_images = 10, mode = 'fifo')
+        self.cam_handle.record(number_of_images = max(4, int(self.params['fifo_size'])), mode = 'fifo')
+        self.pending.clear()
+        self.fifo_stats = {'frames': 0, 'batches': 0, 'max_batch': 0, 'fifo_overflow_events': 0}
+        self.fifo_overflowed = False # the recorder overflow flag is sticky, only its rising edges are counted
         self.is_recording = True
 
     def stop(self):
         if hasattr(self, 'cam_handle') and self.cam_handle is not None:
             self.cam_handle.stop()
             self.is_recording = False
-            display('PCO cam stopped.')
+            s = self.fifo_stats
+            display(f"PCO cam stopped ({s.get('frames', 0)} frames in {s.get('batches', 0)} batches, "
+                    f"largest batch {s.get('max_batch', 0)}, {s.get('fifo_overflow_events', 0)} FIFO overflow events).")
         else:
             display('PCO cam stop() called, but camera was never opened.', level='warning')
 
@@ -129,10 +144,81 @@ class PCOCam(GenericCam):
             return -1
         return 0
 
+    def get_acquisition_stats(self):
+        return dict(self.fifo_stats)
+
+    def _fifo_level(self):
+        status = self.cam_handle.rec.get_status()
+        overflowed = bool(status['bFIFOOverflow'])
+        if overflowed and not self.fifo_overflowed:
+            self.fifo_stats['fifo_overflow_events'] += 1
+        self.fifo_overflowed = overflowed
+        return status['dwProcImgCount']
+
+    def _wait_for_images(self):
+        """polls the recorder until images are available, returns the number of images in the FIFO (0 on timeout)"""
+        t_stop = time.time() + self.params['poll_timeout']
+        while True:
+            level = self._fifo_level()
+            if level or time.time() > t_stop:
+                return level
+            time.sleep(0.0005)
+
+    def _get_timestamps(self, frames, metas):
+        """camera timestamps in s (POSIX time, from the camera clock), time.time() if the camera does not stamp the frames"""
+        if metas and isinstance(metas[0].get('timestamp'), dict): # recorder decoded the timestamp struct
+            return [calendar.timegm((t['year'], t['month'], t['day'], t['hour'], t['minute'], t['second']))
+                    + t['microsecond'] * 1e-6 for t in (m['timestamp'] for m in metas)]
+        if self.params['timestamp'] in ['binary', 'binary & ascii']:
+            return decode_binary_timestamps(np.stack([f.reshape(-1)[:14] for f in frames]))
+        return [time.time()] * len(frames)
+
+    def _drain_fifo(self):
+        """reads every image in the FIFO with one images() call"""
+        n = self._wait_for_images()
+        if n == 0:
+            return 0
+        frames, metas = self.cam_handle.images(blocksize = n)
+        timestamps = self._get_timestamps(frames, metas)
+        for frame, meta, timestamp in zip(frames, metas, timestamps):
+            self.pending.append((frame, (meta['camera image number'], timestamp)))
+        stats = self.fifo_stats
+        stats['frames'] += n
+        stats['batches'] += 1
+        stats['max_batch'] = max(stats['max_batch'], n)
+        return n
+
     def image(self):
         if not hasattr(self, 'cam_handle') or self.cam_handle is None:
             display('PCO cam image() called, but camera was never opened.', level='warning')
             return None, 'not recording'
+        if self.params['acquisition'] == 'bulk':
+            if not self.pending and self._drain_fifo() == 0:
+                return None, 'timeout'
+            return self.pending.popleft()
         self.cam_handle.wait_for_first_image()
         frame, meta = self.cam_handle.image()
-        return frame, (meta['camera image number'], time.time())
+        return frame, (meta['camera image number'], self._get_timestamps([frame], [meta])[0])
+
+    def images(self, max_n = 64, timeout = None):
+        if not hasattr(self, 'cam_handle') or self.cam_handle is None or self.params['acquisition'] != 'bulk':
+            return super().images(max_n, timeout)
+        if not self.pending and self._drain_fifo() == 0:
+            return None, 'timeout'
+        batch = [self.pending.popleft() for _ in range(min(max_n, len(self.pending)))]
+        return np.stack([frame for frame, _ in batch]), make_metadata_records([meta for _, meta in batch])
+
+def decode_binary_timestamps(pixels):
+    """decodes the pco binary timestamps, pixels: (n_frames, 14) first pixels of the frames, one BCD byte per pixel.
+    Returns the camera times in s (POSIX time)"""
+    bcd = pixels.astype(np.int64) & 0xFF
+    digits = (bcd >> 4) * 10 + (bcd & 0x0F)
+    timestamps = []
+    for d in digits:
+        year = d[4] * 100 + d[5]
+        try:
+            t = calendar.timegm((year, d[6], d[7], d[8], d[9], d[10]))
+        except (ValueError, OverflowError):
+            t = 0
+        timestamps.append(t + (d[11] * 10000 + d[12] * 100 + d[13]) * 1e-6)
+    return timestamps
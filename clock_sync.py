@@ -0,0 +1,73 @@
+"""clock_sync.py
+Mapping of the camera (device) clock to the host monotonic clock.
+The handler latches the device clock against time.monotonic_ns() at a fixed interval
+(cam.latch_timestamp(), GenICam TimestampLatch or equivalent) and the ClockModel fits
+offset and drift on the recent latches. Frame timestamps of a whole batch are then
+mapped to host time in one call (to_host).
+"""
+from collections import deque
+import numpy as np
+
+class ClockModel:
+    """Online linear fit host_time = offset + slope * device_time on the last `window` latches.
+    device times are in s (device clock), host times in ns (time.monotonic_ns).
+    The jitter is the error of every new latch against the prediction of the fit before it
+    was added, i.e. how far off a mapped frame timestamp can be.
+    """
+    def __init__(self, window = 32, source = 'latch'):
+        self.window = window
+        self.default_source = source # 'latch' (device latch) or 'arrival' (frame arrival time, includes the transfer latency)
+        self.reset()
+
+    def reset(self):
+        self.source = self.default_source # the handler switches to 'arrival' when the latch fails
+        self.latches = deque(maxlen = self.window)
+        self.device_origin = None
+        self.host_origin = None
+        self.slope = 1.
+        self.offset = 0. # s, host - host_origin at device_origin
+        self.n_latches = 0
+        self.n_residuals = 0
+        self.sum_sq_residuals = 0.
+        self.max_residual = 0.
+
+    @property
+    def is_valid(self):
+        return self.n_latches > 0
+
+    def add_latch(self, device_time, host_time_ns):
+        if self.device_origin is None:
+            self.device_origin = float(device_time)
+            self.host_origin = int(host_time_ns)
+        x = float(device_time) - self.device_origin
+        y = (int(host_time_ns) - self.host_origin) * 1e-9
+        if self.n_latches >= 2:
+            residual = y - (self.offset + self.slope * x)
+            self.n_residuals += 1
+            self.sum_sq_residuals += residual ** 2
+            self.max_residual = max(self.max_residual, abs(residual))
+        self.latches.append((x, y))
+        self.n_latches += 1
+        self._fit()
+
+    def _fit(self):
+        x, y = np.array(self.latches).T
+        if len(x) >= 2 and np.ptp(x) > 0:
+            self.slope, self.offset = np.polyfit(x - x.mean(), y, 1)
+            self.offset -= self.slope * x.mean()
+        else: # drift unknown yet
+            self.slope = 1.
+            self.offset = float(np.mean(y - x))
+
+    def to_host(self, device_times):
+        """Device times (s, scalar or array) to host monotonic ns (int64)"""
+        x = np.asarray(device_times, dtype = np.float64) - self.device_origin
+        return self.host_origin + np.rint((self.offset + self.slope * x) * 1e9).astype(np.int64)
+
+    def summary(self):
+        jitter_std = np.sqrt(self.sum_sq_residuals / self.n_residuals) if self.n_residuals else 0.
+        return {'source': self.source,
+                'n_latches': self.n_latches,
+                'drift_ppm': float((self.slope - 1.) * 1e6), # host s per device s, -1
+                'jitter_std_us': float(jitter_std * 1e6),
+                'jitter_max_us': float(self.max_residual * 1e6)}
@@ -2,34 +2,224 @@
 import time
 import sys
 import os
-from os.path import join, isfile, dirname
-from multiprocessing import Process,Queue,Event,Array,Value
+import subprocess
+import mmap
+import bisect
+from os.path import join, dirname
+from multiprocessing import Process,Array,Value
+from multiprocessing import Queue as mp_Queue, Event as mp_Event, Semaphore as mp_Semaphore
 import queue
+import json
+import threading
 from datetime import datetime
 import numpy as np
 from tifffile import imread, TiffFile, TiffWriter as twriter
-from skvideo.io import FFmpegWriter
 import cv2
-from NeuCams.utils import display
-from NeuCams.cams.avt_cam import AVTCam
-from multiprocessing import shared_memory
+from importlib.util import find_spec
+try:
+    import fcntl
+except ImportError: # windows
+    fcntl = None
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from NeuCams.utils import display, TransportMonitor
+from NeuCams.shared_buffers import SharedFrameRing
+from NeuCams.frame_metadata import FrameMetadataLog
+from NeuCams.process_placement import apply_placement
+from NeuCams.raw_header import pack_raw_header, get_raw_codecs, RAW_HEADER_SIZE, RAW_GROUP_HEADER, RAW_CODECS, RAW_SHUFFLE
 
 VERSION = 'B0.6'
 
-def debug_pickle(obj, prefix=''):
-    import pickle, collections.abc
-    try:
-        pickle.dumps(obj)
-        # print(prefix, '✅ picklable', type(obj))
-    except Exception as e:
-        # print(prefix, '❌ NOT picklable', type(obj), '→', e)
-        if isinstance(obj, (list, tuple, set)):
-            for i, item in enumerate(obj):
-                debug_pickle(item, prefix + f'  [{i}] ')
-        elif isinstance(obj, dict):
-            for k, v in obj.items():
-                debug_pickle(k, prefix + '  {key} ')
-                debug_pickle(obj[k], prefix + f'  {k}: ')
+OVERFLOW_POLICIES = ['block', 'drop_newest', 'drop_oldest', 'spill']
+WRITER_MODES = ['process', 'thread']
+WRITE_LATENCY_EDGES_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500] # upper edges of the block write latency bins
+
+class WriterCounters:
+    """Shared counters of a writer queue, readable from any process (GUI, UDP server).
+    Per run: the CameraHandler resets them at the start of every run (reset_run)."""
+    def __init__(self):
+        self.dropped = Value('i', 0)
+        self.spilled = Value('i', 0)
+        self.queue_depth = Value('i', 0)
+        self.high_water = Value('i', 0)
+        self.bytes_written = Value('q', 0)
+        self.write_latency = Array('q', len(WRITE_LATENCY_EDGES_MS) + 1) # block writes per latency bin (BlockFile)
+        self.write_latency_max = Value('d', 0.)
+    
+    def queued(self, n = 1):
+        with self.queue_depth.get_lock():
+            self.queue_depth.value += n
+            depth = self.queue_depth.value
+        if depth > self.high_water.value:
+            self.high_water.value = depth
+    
+    def dequeued(self, n = 1):
+        with self.queue_depth.get_lock():
+            self.queue_depth.value -= n
+    
+    def reset_run(self):
+        """The counters are per run, the queue depth is not (frames can still be queued)"""
+        for counter in [self.dropped, self.spilled, self.bytes_written]:
+            counter.value = 0
+        self.high_water.value = self.queue_depth.value
+        with self.write_latency.get_lock():
+            self.write_latency[:] = [0] * len(self.write_latency)
+        self.write_latency_max.value = 0.
+    
+    def block_written(self, nbytes, duration):
+        i = bisect.bisect_left(WRITE_LATENCY_EDGES_MS, duration * 1e3)
+        with self.write_latency.get_lock():
+            self.write_latency[i] += 1
+            self.bytes_written.value += nbytes
+            if duration > self.write_latency_max.value:
+                self.write_latency_max.value = duration
+    
+    def as_dict(self):
+        counters = {'dropped': self.dropped.value, 'spilled': self.spilled.value,
+                    'queue_depth': self.queue_depth.value, 'high_water': self.high_water.value}
+        if self.bytes_written.value > 0:
+            counters['bytes_written'] = self.bytes_written.value
+            counters['write_latency_max_ms'] = round(self.write_latency_max.value * 1e3, 2)
+            for edge, n in zip(WRITE_LATENCY_EDGES_MS, self.write_latency[:]):
+                counters[f'write_latency_le_{edge}ms'] = n
+            counters[f'write_latency_gt_{WRITE_LATENCY_EDGES_MS[-1]}ms'] = self.write_latency[-1]
+        return counters
+
+class SpillFile:
+    """Raw overflow file, frames are appended by the producer when the writer queue is full.
+    Frame shape and dtype are in the filename like the BinaryWriter files, 
+    frame ids and timestamps go to a csv next to it."""
+    def __init__(self, folder, filepath, frame):
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        n_chan = frame.shape[2] if frame.ndim == 3 else 1
+        name = os.path.splitext(os.path.basename(filepath))[0]
+        name = f"{name}_spill_{n_chan}_{frame.shape[0]}_{frame.shape[1]}_{frame.dtype.name}"
+        self.filepath = join(folder, name + '.dat')
+        display('Writer queue full, spilling to: ' + self.filepath, level='warning')
+        self.file_handler = open(self.filepath, 'ab')
+        self.meta_handler = open(join(folder, name + '.csv'), 'a')
+    
+    def write(self, frame, metadata):
+        self.file_handler.write(np.ascontiguousarray(frame))
+        self.meta_handler.write('{0},{1}\n'.format(*metadata[:2]))
+    
+    def close(self):
+        self.file_handler.close()
+        self.meta_handler.close()
+
+class BlockFile:
+    """Write-only file for the raw and container writers. Writes are coalesced in a block_mb
+    buffer and reach the file as whole blocks at block aligned offsets.
+        direct   : O_DIRECT (linux), bypasses the page cache. Falls back to buffered writes
+                   when the platform or the file system does not support it
+        fadvise  : drops the written blocks from the page cache (posix_fadvise DONTNEED)
+        fsync_mb : fsync every fsync_mb MB, 0 leaves the writeback to the OS
+    The duration of every block write (with its fsync) goes to the counters latency histogram.
+    Data already written can be overwritten with write_at (headers), the file is truncated
+    to what was written when closed.
+    """
+    alignment = 4096
+    
+    def __init__(self, filepath, block_mb = 16, direct = False, fadvise = False, fsync_mb = 0, counters = None):
+        self.filepath = filepath
+        self.block_nbytes = max(self.alignment, int(block_mb * 2**20) // self.alignment * self.alignment)
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0)
+        self.direct = False
+        if direct and not hasattr(os, 'O_DIRECT'):
+            display('O_DIRECT is not available on this platform, using buffered writes.', level='warning')
+        elif direct:
+            try:
+                self.fd = os.open(filepath, flags | os.O_DIRECT, 0o644)
+                self.direct = True
+            except OSError as e:
+                display(f'Could not open {filepath} with O_DIRECT ({e}), using buffered writes.', level='warning')
+        if not self.direct:
+            self.fd = os.open(filepath, flags, 0o644)
+        self.buffer = mmap.mmap(-1, self.block_nbytes) # page aligned, as O_DIRECT needs
+        self.view = memoryview(self.buffer)
+        self.fill = 0 # bytes in the buffer
+        self.flushed = 0 # file offset of the buffer
+        self.synced = 0
+        self.fadvise = fadvise and hasattr(os, 'posix_fadvise')
+        self.fsync_nbytes = int(fsync_mb * 2**20)
+        self.counters = counters
+    
+    def fileno(self):
+        return self.fd
+    
+    def tell(self):
+        return self.flushed + self.fill
+    
+    def truncate(self, size):
+        os.ftruncate(self.fd, size)
+    
+    def write(self, data):
+        """data: bytes or C contiguous array"""
+        data = memoryview(data).cast('B')
+        i = 0
+        while i < len(data):
+            n = min(len(data) - i, self.block_nbytes - self.fill)
+            self.view[self.fill:self.fill + n] = data[i:i + n]
+            self.fill += n
+            i += n
+            if self.fill == self.block_nbytes:
+                self._write_block(self.block_nbytes)
+                self.flushed += self.block_nbytes
+                self.fill = 0
+        return len(data)
+    
+    def _write_block(self, nbytes):
+        t = time.perf_counter()
+        self._write_fd(self.view[:nbytes], self.flushed)
+        end = self.flushed + nbytes
+        if self.fsync_nbytes > 0 and end - self.synced >= self.fsync_nbytes:
+            os.fsync(self.fd)
+            self.synced = end
+        if self.fadvise: # starts the writeback of this block, drops the previous one (written back by now)
+            start = max(0, self.flushed - self.block_nbytes)
+            os.posix_fadvise(self.fd, start, end - start, os.POSIX_FADV_DONTNEED)
+        if self.counters is not None:
+            self.counters.block_written(nbytes, time.perf_counter() - t)
+    
+    def _write_fd(self, data, offset):
+        os.lseek(self.fd, offset, os.SEEK_SET)
+        while len(data):
+            data = data[os.write(self.fd, data):]
+    
+    def write_at(self, data, offset):
+        """Overwrites bytes already written, with O_DIRECT the part already in the file has to be aligned"""
+        data = memoryview(data).cast('B')
+        end = offset + len(data)
+        if end > self.flushed: # part still in the buffer
+            start = max(offset, self.flushed)
+            self.view[start - self.flushed:end - self.flushed] = data[start - offset:]
+        if offset < self.flushed:
+            data = data[:self.flushed - offset]
+            if self.direct:
+                if offset % self.alignment or len(data) % self.alignment:
+                    raise ValueError('O_DIRECT writes have to be aligned')
+                aligned = mmap.mmap(-1, len(data))
+                aligned[:] = data
+                data = aligned
+            self._write_fd(memoryview(data), offset)
+    
+    def close(self):
+        size = self.tell()
+        if self.fill > 0:
+            nbytes = self.fill
+            if self.direct: # padded to the alignment, truncated below
+                nbytes = -(-self.fill // self.alignment) * self.alignment
+                self.view[self.fill:nbytes] = bytes(nbytes - self.fill)
+            self._write_block(nbytes)
+        os.ftruncate(self.fd, size)
+        if self.fsync_nbytes > 0:
+            os.fsync(self.fd)
+        if self.fadvise:
+            os.posix_fadvise(self.fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        os.close(self.fd)
+        self.view.release()
+        self.buffer.close()
 
 class FileWriter(Process):
     """Abstract class to write to file(s)
@@ -38,14 +228,76 @@ class FileWriter(Process):
     Final format is: 
     {filepath}.extension if that file not already present
     otherwise {filepath}_i.extension where i is the first index available in the folder (does not overwrite)
+    
+    Transport (how frames reach the writer process):
+        'queue' : frames are pickled through inQ (default)
+        'shm'   : frames are copied into a shared memory ring owned by the writer,
+                  only (slot, metadata) descriptors go through inQ. Needs frame_format
+                  (height, width, n_chan, dtype). save() returns False when the ring is full.
+    transport_check = N samples 1 in N payloads to report serialization size and cost (see TransportMonitor).
+    
+    Queue bound (max_queue_frames and/or max_queue_bytes, 0 is unbounded; the shm ring is always bounded)
+    and what happens when it is reached (overflow_policy):
+        'block'       : save() waits until the writer catches up (stalls the camera loop)
+        'drop_newest' : the new frame is dropped (default)
+        'drop_oldest' : the oldest queued frame is dropped to make room
+        'spill'       : the new frame is written raw to spill_folder by the caller
+    Dropped/spilled frames and the queue depth high-water mark are kept in shared counters (WriterCounters).
+    
+    save_batch(frames, records) queues a whole batch (from GenericCam.images) as one queue entry,
+    the queue bound still counts frames and the overflow policy applies to each frame of the batch.
+    The writer process writes it with _write_frames per file.
+    
+    Every file gets a {file}.meta.npy sidecar with one FRAME_METADATA_DTYPE record per frame (see frame_metadata).
+    With a sync_log (frame_sync.SyncLog) the writer sends the sync rows of the save_batch frames once they are written
+    and the end of every run.
+    
+    placement = {'name', 'cpus', 'priority'} is applied when the process starts (see process_placement).
+    
+    writer_mode:
+        'process' : the writer is a separate process (default)
+        'thread'  : the writer runs as a thread of the calling (camera) process, frames are passed
+                    by reference through an in-memory queue, no pickling. Same interface, no shm
+                    transport and no placement (they are the camera process').
     """
-    sleeptime = 0.05
     queue_timeout = 0.05
+    idle_timeout = 1.0 # the writer blocks on inQ, wakes up at least this often
+    options = () # writer specific keyword arguments that can be set in the recorder_params
+    uses_threads = False # compresses on a thread pool or pipes to a subprocess, not pinned by the 'auto' placement
     
     def __init__(self, filepath,
                        extension = "log",
-                       frames_per_file = 0):
+                       frames_per_file = 0,
+                       transport = 'queue',
+                       frame_format = None,
+                       ring_slots = 64,
+                       transport_check = 0,
+                       max_queue_frames = 0,
+                       max_queue_bytes = 0,
+                       overflow_policy = 'drop_newest',
+                       spill_folder = None,
+                       counters = None,
+                       placement = None,
+                       writer_mode = 'process',
+                       file_log = None,
+                       sync_log = None,
+                       **kwargs):
         super().__init__()
+        if writer_mode not in WRITER_MODES:
+            display(f'Writer - unknown writer_mode {writer_mode}, using process.', level='warning')
+            writer_mode = 'process'
+        self.writer_mode = writer_mode
+        self.placement = placement if writer_mode == 'process' else None
+        self.file_log = file_log # (filepath, n_frames, chunk) of every closed file and None at the end of a run, used by the WriterPool
+        self.sync_log = sync_log
+        self.pool_chunk = None # WriterPool chunk of the frames queued by save(), they go to the file of that chunk
+        self._thread = None
+        if writer_mode == 'thread':
+            Event, Queue, Semaphore = threading.Event, queue.Queue, threading.Semaphore
+            if transport == 'shm':
+                transport = 'queue' # frames are not copied between processes anyway
+        else:
+            Event, Queue, Semaphore = mp_Event, mp_Queue, mp_Semaphore
         self.filepath_array = Array('u',' ' * 1024)
         self.filepath = filepath
         
@@ -54,23 +306,87 @@ class FileWriter(Process):
         self.frames_per_file = frames_per_file
 
         self.start_flag = Event()
-        self.stop_flag  = Event()
         self.close_flag = Event()
         
         self.is_run_closed = Event()
         
+        self.counters = counters if counters is not None else WriterCounters()
+        self.overflow_policy = overflow_policy
+        if overflow_policy not in OVERFLOW_POLICIES:
+            display(f'Writer - unknown overflow_policy {overflow_policy}, using drop_newest.', level='warning')
+            self.overflow_policy = 'drop_newest'
+        if self.overflow_policy == 'spill' and spill_folder is None:
+            display('Writer - spill policy needs a spill_folder, using drop_newest.', level='warning')
+            self.overflow_policy = 'drop_newest'
+        self.spill_folder = spill_folder
+        self.spill_file = None
+        max_queued = self._get_max_queued(max_queue_frames, max_queue_bytes, frame_format)
+        self.max_queued = max_queued
+        
+        # the bound is in frames, not queue entries (a batch is one entry)
         self.inQ = Queue()
+        
+        self.transport_monitor = TransportMonitor(transport_check, name = f'Writer {extension}')
+        self.frame_ring = None
+        if transport == 'shm':
+            self._init_frame_ring(frame_format, max_queued if max_queued > 0 else ring_slots)
+        # one permit per queued frame, the shm ring slots already bound its queue
+        self.queue_slots = Semaphore(max_queued) if max_queued > 0 and self.frame_ring is None else None
 
         self.file_handler = None
         self.start()
         self.start_flag.wait() #do not return handle before process started
 
+    def _init_frame_ring(self, frame_format, ring_slots):
+        if frame_format is None:
+            display('Writer - shm transport needs the frame format, using the queue transport.', level='warning')
+            return
+        shape = (frame_format['height'], frame_format['width'], frame_format.get('n_chan', 1))
+        self.frame_ring = SharedFrameRing(ring_slots, shape, frame_format['dtype'])
+        self.free_slots = mp_Queue()
+        for slot in range(ring_slots):
+            self.free_slots.put(slot)
+
+    @staticmethod
+    def _get_max_queued(max_queue_frames, max_queue_bytes, frame_format):
+        max_queued = max_queue_frames
+        if max_queue_bytes > 0:
+            if frame_format is None:
+                display('Writer - max_queue_bytes needs the frame format, ignored.', level='warning')
+            else:
+                frame_nbytes = (frame_format['height'] * frame_format['width'] * frame_format.get('n_chan', 1) 
+                                * np.dtype(frame_format['dtype']).itemsize)
+                max_frames = max(1, int(max_queue_bytes // frame_nbytes))
+                max_queued = min(max_queued, max_frames) if max_queued > 0 else max_frames
+        return max_queued
+
+    def start(self):
+        if self.writer_mode == 'thread':
+            self._thread = threading.Thread(target = self.run, name = f'Writer {self.extension}', daemon = True)
+            self._thread.start()
+        else:
+            super().start()
+    
+    def join(self, timeout = None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+        else:
+            super().join(timeout)
+    
+    def is_alive(self):
+        if self._thread is not None:
+            return self._thread.is_alive()
+        return super().is_alive()
+
     def __enter__(self):
         return self
         
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.close()
         self.join()
+        self._close_spill_file()
+        if self.frame_ring is not None:
+            self.frame_ring.close()
     
     def get_filepath(self):
         """To access filepath outside of process
@@ -78,8 +394,9 @@ class FileWriter(Process):
         return str(self.filepath_array[:]).strip(' ')
         
     def set_filepath(self, filepath):
+        self._close_spill_file()
         if self.start_flag.is_set():
-            self.stop_flag.set()
+            self._end_run()
             self.is_run_closed.wait()
             self.is_run_closed.clear()
         filepath = self.get_complete_filepath(filepath)
@@ -94,7 +411,7 @@ class FileWriter(Process):
         """
         i = 1
         complete_filepath = f"{filepath}_{i}.{self.extension}"
-        while isfile(complete_filepath):
+        while os.path.exists(complete_filepath): # zarr files are folders
             i += 1
             complete_filepath = f"{filepath}_{i}.{self.extension}"
         return complete_filepath
@@ -105,8 +422,21 @@ class FileWriter(Process):
         for i in range(len(filepath)):
             self.filepath_array[i] = filepath[i]
 
+    def _get_next_filepath(self, filepath):
+        """Filepath of the next file of the run (frames_per_file rollover): {filepath}_{i+1}.extension or the next available"""
+        stem, extension = os.path.splitext(filepath)
+        base, i = stem.rsplit('_', 1)
+        i = int(i) + 1
+        while os.path.exists(f"{base}_{i}{extension}"):
+            i += 1
+        return f"{base}_{i}{extension}"
+
     def _init_file_handler(self, frame):
         """open file generic"""
+        self._close_file()
+        self.file_index += 1
+        if self.file_index > 0:
+            self.update_filepath_array(self._get_next_filepath(self.get_filepath()))
         self.filepath = self.get_filepath()
         folder = dirname(self.filepath)
         if not os.path.exists(folder):
@@ -114,8 +444,19 @@ class FileWriter(Process):
                 os.makedirs(folder)
             except Exception as e:
                 print(f"Could not create folder {folder} : {e}")
-        self._release_file_handler()
+        self.current_filepath = self.filepath # subclasses update it if they change the name
+        self.file_pool_chunk = self.next_pool_chunk
         self.file_handler = self._get_file_handler(self.filepath,frame)
+        self.file_frame_count = 0
+        
+    def _close_file(self):
+        """closes the current file and writes its metadata sidecar"""
+        self._release_file_handler()
+        if len(self.metadata_log) > 0:
+            self.metadata_log.save(self.current_filepath)
+            if self.file_log is not None:
+                self.file_log.put((self.current_filepath, len(self.metadata_log), self.file_pool_chunk))
+            self.metadata_log.clear()
         
     def _get_file_handler(self, filepath, frame):
         """get specific file handler"""
@@ -132,177 +473,829 @@ class FileWriter(Process):
         pass
 
     def save(self,frame,metadata):
+        """Queues a frame for writing, returns False if it could not be queued (dropped)"""
+        if self.frame_ring is not None:
+            return self._save_to_ring(frame, metadata)
+        if frame.base is not None:
+            # views on a driver frame ring are reused, the queue pickles asynchronously
+            frame = frame.copy()
+        if not self._make_room(1):
+            return self._overflow(frame, metadata)
+        payload = self._payload(frame, metadata)
+        self.transport_monitor.check(payload)
+        self.inQ.put(payload)
+        self.counters.queued()
+        return True
+    
+    def save_batch(self, frames, records):
+        """Queues a batch of frames with their FRAME_METADATA_DTYPE records, returns the number of frames queued
+        or spilled (drop_oldest can still take them out of the queue later, counted in counters.dropped)"""
+        if self.frame_ring is not None:
+            return self._save_batch_to_ring(frames, records)
+        if frames.base is not None:
+            frames = frames.copy()
+        n_saved = 0
+        # a batch larger than the bound goes in several entries
+        step = self.max_queued if self.queue_slots is not None else len(frames)
+        for i in range(0, len(frames), step):
+            n = self._make_room(min(step, len(frames) - i))
+            if n > 0:
+                payload = self._payload(frames[i:i + n], records[i:i + n])
+                self.transport_monitor.check(payload)
+                self.inQ.put(payload)
+                self.counters.queued(n)
+                n_saved += n
+            if i + n < min(i + step, len(frames)):
+                # the newest frames of the batch did not fit
+                n_saved += sum(self._overflow(frame, (record['frame_id'], record['timestamp']))
+                               for frame, record in zip(frames[i + n:], records[i + n:]))
+                break
+        return n_saved
+    
+    def _save_batch_to_ring(self, frames, records):
+        """One (slots, records) descriptor for the frames that got a slot, the others overflow"""
+        slots = []
+        for frame in frames:
+            if self.overflow_policy == 'block':
+                slot = self._wait_until(lambda: self.free_slots.get(timeout = self.queue_timeout), queue.Empty)
+            else:
+                try:
+                    slot = self.free_slots.get_nowait()
+                except queue.Empty:
+                    break
+            self.frame_ring[slot][:] = np.reshape(frame, self.frame_ring.shape)
+            slots.append(slot)
+        n_saved = len(slots)
+        if n_saved:
+            payload = self._payload(np.array(slots), records[:n_saved])
+            self.transport_monitor.check(payload)
+            self.inQ.put(payload)
+            self.counters.queued(n_saved)
+        for i in range(n_saved, len(frames)):
+            # drop_oldest frees slots one by one, the batch does not wait for that,
+            # the frames that get one go as batches of one to keep their records
+            slot = self._get_ring_slot()
+            if slot is None:
+                n_saved += self._overflow(frames[i], (records[i]['frame_id'], records[i]['timestamp']))
+                continue
+            self.frame_ring[slot][:] = np.reshape(frames[i], self.frame_ring.shape)
+            payload = self._payload(np.array([slot]), records[i:i + 1])
+            self.transport_monitor.check(payload)
+            self.inQ.put(payload)
+            self.counters.queued()
+            n_saved += 1
+        return n_saved
+    
+    def _get_ring_slot(self):
+        """A free ring slot, None if there is none and the policy does not make one"""
+        if self.overflow_policy == 'block':
+            return self._wait_until(lambda: self.free_slots.get(timeout = self.queue_timeout), queue.Empty)
+        try:
+            return self.free_slots.get_nowait()
+        except queue.Empty:
+            # backpressure: the writer did not release any slot yet
+            return self._drop_oldest() if self.overflow_policy == 'drop_oldest' else None
+    
+    def _save_to_ring(self, frame, metadata):
+        slot = self._get_ring_slot()
+        if slot is None:
+            return self._overflow(frame, metadata)
+        self.frame_ring[slot][:] = np.reshape(frame, self.frame_ring.shape)
+        payload = self._payload(slot, metadata)
+        self.transport_monitor.check(payload)
+        self.inQ.put(payload)
+        self.counters.queued()
+        return True
+    
+    def _make_room(self, n):
+        """Takes queue room for up to n frames, returns how many fit.
+        block waits and drop_oldest drops the oldest entries until all n fit,
+        drop_newest and spill take the room there is."""
+        if self.queue_slots is None:
+            return n
+        reserved = 0
+        while reserved < n:
+            if self.queue_slots.acquire(False):
+                reserved += 1
+            elif self.overflow_policy == 'block':
+                if not self.queue_slots.acquire(timeout = self.queue_timeout):
+                    if not self.is_alive():
+                        self._release_room(reserved)
+                        raise queue.Full
+                    continue
+                reserved += 1
+            elif not (self.overflow_policy == 'drop_oldest' and self._drop_oldest()):
+                break
+        return reserved
+    
+    def _release_room(self, n):
+        if self.queue_slots is not None:
+            for _ in range(n):
+                self.queue_slots.release()
+    
+    def _dequeued(self, n = 1):
+        """n frames left the queue (written or dropped)"""
+        self._release_room(n)
+        self.counters.dequeued(n)
+    
+    def _payload(self, frames, metadata):
+        """inQ entry, tagged with the pool chunk if there is one"""
+        if self.pool_chunk is None:
+            return (frames, metadata)
+        return (frames, metadata, self.pool_chunk)
+    
+    def _wait_until(self, func, exception):
+        """Retries func until it does not raise exception, gives up if the writer process died"""
+        while True:
+            try:
+                return func()
+            except exception:
+                if not self.is_alive():
+                    raise
+    
+    def _drop_oldest(self):
+        """Takes the oldest entry back from the queue, returns its slot (shm) or True"""
         try:
-            # QUEUE DEBUG
-            import numpy as np
-            # Remove type/shape debug prints
-            debug_pickle((frame,metadata), 'QUEUE PAYLOAD')
-            self.inQ.put((frame,metadata), timeout = self.queue_timeout)
-        except queue.Full:
-            print("ERROR: could not save image, queue is full")
+            # short timeout: the entry can still be in the queue feeder thread
+            buff = self.inQ.get(timeout = self.queue_timeout)
+        except queue.Empty:
+            return None
+        n = len(buff[1]) if isinstance(buff[1], np.ndarray) else 1
+        self._dequeued(n)
+        with self.counters.dropped.get_lock():
+            self.counters.dropped.value += n
+        if self.frame_ring is None:
+            return True
+        if n == 1 and not isinstance(buff[1], np.ndarray):
+            return buff[0]
+        slots = list(buff[0])
+        for slot in slots[1:]:
+            self.free_slots.put(slot)
+        return slots[0]
+    
+    def _overflow(self, frame, metadata):
+        if self.overflow_policy == 'spill':
+            if self.spill_file is None:
+                self.spill_file = SpillFile(self.spill_folder, self.get_filepath(), frame)
+            self.spill_file.write(frame, metadata)
+            with self.counters.spilled.get_lock():
+                self.counters.spilled.value += 1
+            return True
+        with self.counters.dropped.get_lock():
+            self.counters.dropped.value += 1
+        return False
+    
+    def _close_spill_file(self):
+        if self.spill_file is not None:
+            self.spill_file.close()
+            self.spill_file = None
     
     def run(self):
+        if self.placement is not None:
+            apply_placement(**self.placement)
         self.set_filepath(self.filepath)
         self.start_flag.set()
+        self.metadata_log = FrameMetadataLog()
+        self.file_pool_chunk = None
         while not self.close_flag.is_set():
             self.saved_frame_count = 0
-            while not self.stop_flag.is_set():
-                time.sleep(self.sleeptime)
-                self._process_queue()
+            self.file_index = -1
+            self.next_pool_chunk = None
+            self._process_queue()
             self._close_run()
+        if self.frame_ring is not None:
+            self.frame_ring.close()
+    
+    def _end_run(self):
+        """Queues the end of run marker, frames queued before it are still written"""
+        self.inQ.put(None)
     
     def _close_run(self):
-        self._release_file_handler()
+        self._close_file()
+        if self.file_log is not None:
+            self.file_log.put(None)
+        if self.sync_log is not None:
+            self.sync_log.end(self.saved_frame_count)
         # if not self.saved_frame_count == 0:
             # display("[Writer] Wrote {0} frames at {1}.".format(self.saved_frame_count,
                                                                # self.filepath))
-        self.stop_flag.clear()
         self.is_run_closed.set()
   
     def _process_queue(self):
+        """Blocks on inQ and writes frames as they come, until the end of run marker"""
         while True:
             try:
-                self._save_next_in_queue()
+                buff = self.inQ.get(timeout = self.idle_timeout)
             except queue.Empty:
+                continue
+            if buff is None:
                 break
-            
-    def _save_next_in_queue(self):
-        buff = self.inQ.get(timeout = self.queue_timeout)
-        self._handle_frame(buff)
+            self._handle_frame(buff)
 
     def _handle_frame(self, buff):
-        # print(buff, flush=True)
-        frame, metadata = buff
-        # Handle shared memory tuple from AVT
-        if isinstance(frame, tuple) and len(frame) == 3 and isinstance(frame[0], str):
-            shm_name, shape, dtype = frame
-            frame, shm = AVTCam.frame_from_shm(shm_name, shape, dtype)
-            try:
-                if (self.file_handler is None or
-                    (self.frames_per_file > 0 and np.mod(self.saved_frame_count,
-                                                       self.frames_per_file)==0)):
-                    self._init_file_handler(frame)
-                frameid, timestamp = metadata[:2]
-                self._write(frame, frameid, timestamp)
-                self.saved_frame_count += 1
-            finally:
-                shm.close()
-                shm.unlink()
-        else:
-            if (self.file_handler is None or
-                (self.frames_per_file > 0 and np.mod(self.saved_frame_count,
-                                                   self.frames_per_file)==0)):
-                self._init_file_handler(frame)
-            frameid, timestamp = metadata[:2] 
-            self._write(frame,frameid,timestamp)
-            self.saved_frame_count += 1
+        self.next_pool_chunk = buff[2] if len(buff) > 2 else None
+        if isinstance(buff[1], np.ndarray):
+            return self._handle_batch(buff)
+        try:
+            if self.frame_ring is not None:
+                slot, metadata = buff[:2]
+                try:
+                    self._write_frame(self.frame_ring[slot], metadata)
+                finally:
+                    self.free_slots.put(slot)
+            else:
+                frame, metadata = buff[:2]
+                self._write_frame(frame, metadata)
+        finally:
+            self._dequeued()
+    
+    def _handle_batch(self, buff):
+        frames, records = buff[:2]
+        try:
+            if self.frame_ring is not None:
+                slots = frames
+                try:
+                    self._write_batch(self.frame_ring.frames[slots], records)
+                finally:
+                    for slot in slots:
+                        self.free_slots.put(slot)
+            else:
+                self._write_batch(frames, records)
+        finally:
+            self._dequeued(len(records))
+    
+    def _needs_new_file(self):
+        """Rollover every frames_per_file saved frames, or at every new chunk for a pool worker
+        (frames dropped before the writer would misalign the count)"""
+        if self.file_handler is None:
+            return True
+        if self.next_pool_chunk is not None:
+            return self.next_pool_chunk != self.file_pool_chunk
+        return self.frames_per_file > 0 and np.mod(self.saved_frame_count, self.frames_per_file) == 0
+    
+    def _write_frame(self, frame, metadata):
+        if self._needs_new_file():
+            self._init_file_handler(frame)
+        frameid, timestamp = metadata[:2] 
+        self._write(frame,frameid,timestamp)
+        self.metadata_log.append(metadata, self.file_index, self.file_frame_count)
+        self.file_frame_count += 1
+        self.saved_frame_count += 1
+
+    def _write_batch(self, frames, records):
+        """Splits the batch at the file boundaries (frames_per_file)"""
+        i = 0
+        while i < len(frames):
+            if self._needs_new_file():
+                self._init_file_handler(frames[i])
+            n = len(frames) - i
+            if self.frames_per_file > 0 and self.next_pool_chunk is None: # the pool splits batches at the chunks
+                n = min(n, self.frames_per_file - np.mod(self.saved_frame_count, self.frames_per_file))
+            self._write_frames(frames[i:i + n], records[i:i + n])
+            self.metadata_log.extend(records[i:i + n], self.file_index, self.file_frame_count)
+            if self.sync_log is not None:
+                self.sync_log.send(records[i:i + n])
+            self.file_frame_count += n
+            self.saved_frame_count += n
+            i += n
+    
+    def _write_frames(self, frames, records):
+        """write specific, for a batch of frames going to the same file"""
+        for frame, record in zip(frames, records):
+            self._write(frame, record['frame_id'], record['timestamp'])
                 
     def close(self):
         self.close_flag.set()
-        self.stop_flag.set()
+        self._end_run()
         
+class WriterPool:
+    """K writers of the same type for one camera, for encoders that can not keep up alone.
+    Frames are split in chunks of frames_per_file and the chunks go round-robin to the workers,
+    each worker writes its chunks to its own files ({filepath}_w{k}_{i}.extension).
+    Every queued frame is tagged with its chunk, a worker starts a new file at each new chunk
+    (not by counting its saved frames, frames can be dropped before it) and logs the chunk of every file.
+    At the end of every run {filepath}_manifest.json lists the chunk files in frame order,
+    a reader concatenates them to get the run back.
+    Same interface as a FileWriter (set_filepath, save, save_batch, close), the workers
+    share the counters.
+    """
+    default_frames_per_file = 256
+    file_log_timeout = 5.0 # s
+    
+    def __init__(self, writer_class, n_workers, filepath, frames_per_file = 0, counters = None, placement = None, **kwargs):
+        if frames_per_file <= 0:
+            display(f'Writer pool - needs frames_per_file, using {self.default_frames_per_file}.', level='warning')
+            frames_per_file = self.default_frames_per_file
+        self.frames_per_file = frames_per_file
+        self.n_workers = n_workers
+        self.counters = counters if counters is not None else WriterCounters()
+        self.filepath = filepath
+        self.file_logs = [mp_Queue() for _ in range(n_workers)]
+        self.workers = []
+        for k in range(n_workers):
+            worker_placement = None
+            if placement is not None:
+                worker_placement = {**placement, 'name': f"{placement.get('name', 'writer')} {k}"}
+                if placement.get('cpus') and len(placement['cpus']) < n_workers:
+                    worker_placement['cpus'] = None # less cpus than workers, left to the OS
+            self.workers.append(writer_class(filepath = f'{filepath}_w{k}',
+                                             frames_per_file = frames_per_file,
+                                             counters = self.counters,
+                                             placement = worker_placement,
+                                             file_log = self.file_logs[k],
+                                             **kwargs))
+        # save() runs in the calling process, the workers share one monitor there
+        self.transport_monitor = self.workers[0].transport_monitor
+        for worker in self.workers[1:]:
+            worker.transport_monitor = self.transport_monitor
+        self.frame_count = 0
+        display(f'Writer pool - {n_workers} {writer_class.__name__} workers, chunks of {frames_per_file} frames.')
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        for worker in self.workers:
+            worker.__exit__(exc_type, exc_val, exc_tb)
+        self._write_manifest()
+    
+    def get_filepath(self):
+        return self.filepath
+    
+    def set_filepath(self, filepath):
+        for k, worker in enumerate(self.workers):
+            worker.set_filepath(f'{filepath}_w{k}')
+        self._write_manifest() # the workers closed the run files
+        self.filepath = filepath
+        self.frame_count = 0
+    
+    def _worker(self):
+        """Worker of the current chunk, its next frames are tagged with the chunk index"""
+        chunk = self.frame_count // self.frames_per_file
+        worker = self.workers[chunk % self.n_workers]
+        worker.pool_chunk = chunk
+        return worker
+    
+    def save(self, frame, metadata):
+        saved = self._worker().save(frame, metadata)
+        self.frame_count += 1
+        return saved
+    
+    def save_batch(self, frames, records):
+        """Splits the batch at the chunk boundaries"""
+        n_saved = 0
+        i = 0
+        while i < len(frames):
+            n = min(len(frames) - i, self.frames_per_file - self.frame_count % self.frames_per_file)
+            n_saved += self._worker().save_batch(frames[i:i + n], records[i:i + n])
+            self.frame_count += n
+            i += n
+        return n_saved
+    
+    def _read_file_log(self, k):
+        """(filepath, n_frames, chunk) of the files worker k closed in the run, up to its end of run marker"""
+        files = []
+        while True:
+            try:
+                entry = self.file_logs[k].get(timeout = self.file_log_timeout)
+            except queue.Empty:
+                display(f'Writer pool - worker {k} did not close its run.', level='warning')
+                break
+            if entry is None:
+                break
+            files.append(entry)
+        return files
+    
+    def _write_manifest(self):
+        # every worker closed its run, read the logs even if nothing was saved so the next run starts clean
+        files = {}
+        for k in range(self.n_workers):
+            for filepath, n_frames, chunk in self._read_file_log(k):
+                files[chunk] = (filepath, n_frames, k)
+        if self.frame_count == 0:
+            return
+        n_chunks = -(-self.frame_count // self.frames_per_file)
+        chunks = []
+        first_frame = 0
+        for c in range(n_chunks):
+            if c not in files:
+                display(f'Writer pool - chunk {c} was not written.', level='warning')
+                continue
+            filepath, n_frames, k = files[c]
+            chunks.append({'file': os.path.basename(filepath), 'worker': k, 'chunk': c,
+                           'first_frame': first_frame, 'n_frames': n_frames})
+            first_frame += n_frames
+        manifest = {'version': VERSION, 'frames_per_file': self.frames_per_file,
+                    'n_workers': self.n_workers, 'n_frames': first_frame, 'chunks': chunks}
+        with open(self.filepath + '_manifest.json', 'w') as f:
+            json.dump(manifest, f, indent = 4)
+        self.frame_count = 0
+    
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+
+TIFF_CODECS = ['zlib', 'zstd', 'lzw', 'jpegxl'] # all but zlib need imagecodecs (TIFF has no lz4 codec)
+
 class TiffWriter(FileWriter):
+    """BigTIFF stacks, one page per frame.
+    Frames are buffered and written batch_frames at a time. The uncompressed pages of a file are
+    contiguous (tifffile contiguous mode, the page tags are written when the file is closed) so
+    readers can memory map the frames; the last batch of a run, when shorter, is a second series
+    after the tags of the first one.
+    Files roll over at max_file_gb (in whole batches) unless frames_per_file is set.
+    Frame ids and timestamps are in the .meta.npy sidecar, pages have no description.
+    
+    Compression (the pages are then not contiguous):
+        compression       : one of TIFF_CODECS, or a zlib level (1-9)
+        compression_level : codec level (None is the codec default), jpegxl is always lossless
+        predictor         : horizontal differencing before the codec (default for lzw)
+        tile              : (height, width) tiles instead of strips of rowsperstrip rows
+        maxworkers        : threads compressing the strips/tiles of the batch_frames frames of
+                            a write, 0 lets tifffile decide
+    The raw throughput through the encoder and the compression ratio are logged at the end of each run.
+    """
+    options = ('compression', 'batch_frames', 'max_file_gb', 'compression_level', 'predictor',
+               'tile', 'rowsperstrip', 'maxworkers')
+    uses_threads = True
     def __init__(self,
                  filepath,
-                 frames_per_file=256,
-                 compression=None):
+                 frames_per_file = 0,
+                 compression = None,
+                 batch_frames = 64,
+                 max_file_gb = 4,
+                 compression_level = None,
+                 predictor = None,
+                 tile = None,
+                 rowsperstrip = 64,
+                 maxworkers = 4,
+                 **kwargs):
         
         self.compression = None
-        if not compression is None:
+        if isinstance(compression, str):
+            self._set_codec(compression.lower(), compression_level)
+        elif not compression is None:
             if compression > 9:
                 display('Can not use compression over 9 for the TiffWriter')
             elif compression > 0:
-                self.compression = compression
+                self._set_codec('zlib', compression)
+        self.predictor = predictor if predictor is not None else self.compression == 'lzw'
+        self.tile = tuple(tile) if tile else None
+        self.rowsperstrip = rowsperstrip
+        self.maxworkers = maxworkers
+        self.batch_frames = max(1, batch_frames)
+        self.max_file_gb = max_file_gb
+        self.run_frames_per_file = frames_per_file # frames_per_file is set from max_file_gb if 0
+        self.encode_stats = [0, 0, 0., 0] # frames, raw bytes, seconds in write, compressed bytes
                 
         super().__init__(filepath,
                          extension = 'tif',
-                         frames_per_file=frames_per_file)
+                         frames_per_file=frames_per_file,
+                         **kwargs)
+    
+    def _set_codec(self, codec, level):
+        if codec not in TIFF_CODECS:
+            display(f'TiffWriter - unknown compression {codec}, using zlib.', level='warning')
+            codec = 'zlib'
+        if codec != 'zlib' and find_spec('imagecodecs') is None:
+            display(f'TiffWriter - {codec} compression needs imagecodecs, using zlib.', level='warning')
+            codec = 'zlib'
+        self.compression = codec
+        if codec == 'jpegxl':
+            self.compressionargs = {'lossless': True}
+        else:
+            self.compressionargs = {'level': level} if level is not None else {}
         
-
     def _get_file_handler(self,filepath,frame = None):
+        if self.run_frames_per_file == 0 and self.max_file_gb > 0:
+            batch_nbytes = frame.nbytes * self.batch_frames
+            self.frames_per_file = max(1, int(self.max_file_gb * 2**30 // batch_nbytes)) * self.batch_frames
+        shape = frame.shape[:2] if frame.ndim == 2 or frame.shape[2] == 1 else frame.shape
+        self.photometric = 'rgb' if len(shape) == 3 and shape[2] == 3 else 'minisblack'
+        self.batch = np.empty((self.batch_frames, *shape), dtype = frame.dtype)
+        self.batch_count = 0
         display('Opening: '+ filepath)
-        return twriter(filepath)
+        return twriter(filepath, bigtiff = True)
+
+    def _flush(self):
+        if self.batch_count == 0:
+            return
+        frames = self.batch[:self.batch_count]
+        t = time.perf_counter()
+        if self.compression is None:
+            self.file_handler.write(frames, contiguous = True,
+                                    photometric = self.photometric, metadata = None)
+        else:
+            self.file_handler.write(frames, photometric = self.photometric, metadata = None,
+                                    compression = self.compression, compressionargs = self.compressionargs,
+                                    predictor = self.predictor, maxworkers = self.maxworkers,
+                                    tile = self.tile, rowsperstrip = None if self.tile else self.rowsperstrip)
+        self.encode_stats[0] += len(frames)
+        self.encode_stats[1] += frames.nbytes
+        self.encode_stats[2] += time.perf_counter() - t
+        self.batch_count = 0
 
     def _write(self,frame,frameid,timestamp):
-        self.file_handler.save(frame,
-                               compress=self.compression,
-                               description='id:{0};timestamp:{1}'.format(frameid,timestamp))
+        self.batch[self.batch_count] = frame.reshape(self.batch.shape[1:])
+        self.batch_count += 1
+        if self.batch_count == self.batch_frames:
+            self._flush()
+
+    def _write_frames(self, frames, records):
+        frames = frames.reshape(len(frames), *self.batch.shape[1:])
+        i = 0
+        while i < len(frames):
+            n = min(len(frames) - i, self.batch_frames - self.batch_count)
+            self.batch[self.batch_count:self.batch_count + n] = frames[i:i + n]
+            self.batch_count += n
+            i += n
+            if self.batch_count == self.batch_frames:
+                self._flush()
+
+    def _release_file_handler(self):
+        if self.file_handler is not None:
+            self._flush()
+            self.file_handler.close()
+            self.file_handler = None
+            self.encode_stats[3] += os.path.getsize(self.current_filepath)
+
+    def _close_run(self):
+        super()._close_run()
+        n_frames, raw_nbytes, duration, file_nbytes = self.encode_stats
+        if n_frames > 0 and duration > 0:
+            display(f'TiffWriter - {self.compression or "uncompressed"}: {n_frames} frames, '
+                    f'{raw_nbytes / 2**20 / duration:.0f} MB/s ({n_frames / duration:.0f} fps) through the encoder, '
+                    f'ratio {raw_nbytes / max(file_nbytes, 1):.2f}.')
+        self.encode_stats = [0, 0, 0., 0]
 
 class BinaryWriter(FileWriter):
+    """Raw frames after a self-describing header (see raw_header).
+    The file is preallocated by extents of extent_mb (fallocate where available) so it does not
+    grow a few MB at a time, frames are written in aligned blocks of buffer_mb (see BlockFile for
+    direct_io, fadvise and fsync_mb), and the file is truncated to the frames written when it is
+    closed. The header frame count is also updated every time a block reaches the file, to the
+    frames fully written, a file from a crashed run can still be read up to there."""
+    options = ('extent_mb', 'buffer_mb', 'direct_io', 'fadvise', 'fsync_mb')
     def __init__(self, filepath,
                        frames_per_file = 0,
+                       extent_mb = 256,
+                       buffer_mb = 16,
+                       direct_io = False,
+                       fadvise = False,
+                       fsync_mb = 0,
                        **kwargs):
-        super().__init__(filepath = filepath + "_{n_chan}_{H}_{W}_{dtype}",
+        self.extent_nbytes = int(extent_mb * 2**20)
+        self.block_params = {'block_mb': buffer_mb, 'direct': direct_io, 'fadvise': fadvise, 'fsync_mb': fsync_mb}
+        super().__init__(filepath = filepath,
                          frames_per_file=frames_per_file,
-                         extension = 'dat')
+                         extension = 'dat',
+                         **kwargs)
         
     def _get_file_handler(self,filepath,frame = None):
-        dtype = frame.dtype
-        if dtype == np.float32:
-            dtype='float32'
-        elif dtype == np.uint8:
-            dtype='uint8'
-        else:
-            dtype='uint16'
-        filepath = filepath.format(n_chan = frame.shape[2],
-                                        W = frame.shape[1],
-                                        H = frame.shape[0],
-                                    dtype = dtype)
+        self.frame_shape = frame.shape
+        self.frame_dtype = frame.dtype
+        self.frame_nbytes = frame.nbytes
+        self.allocated_nbytes = 0
         display('Opening: '+ filepath)
-        return open(filepath,'wb')
+        file_handler = BlockFile(filepath, counters = self.counters, **self.block_params)
+        file_handler.write(pack_raw_header(self.frame_shape, self.frame_dtype))
+        self.data_nbytes = RAW_HEADER_SIZE
+        self.header_flushed = 0 # file_handler.flushed when the header count was last updated
+        return file_handler
+    
+    def _reserve(self, nbytes):
+        """Preallocates the next extent(s) when the data would not fit"""
+        needed = self.data_nbytes + nbytes
+        if needed <= self.allocated_nbytes:
+            return
+        size = -(-needed // self.extent_nbytes) * self.extent_nbytes
+        try:
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(self.file_handler.fileno(), self.allocated_nbytes, size - self.allocated_nbytes)
+            else:
+                self.file_handler.truncate(size) # NTFS allocates the clusters
+        except OSError as e:
+            display(f'Could not preallocate {self.current_filepath}: {e}', level='warning')
+        self.allocated_nbytes = size
+    
+    def _update_header(self, frame_count):
+        self.file_handler.write_at(pack_raw_header(self.frame_shape, self.frame_dtype, frame_count), 0)
+    
+    def _header_on_flush(self):
+        """Header count of the frames in the blocks that reached the file, when a block was written"""
+        if self.file_handler.flushed > self.header_flushed:
+            self.header_flushed = self.file_handler.flushed
+            self._update_header((self.header_flushed - RAW_HEADER_SIZE) // max(1, self.frame_nbytes))
         
     def _write(self,frame,frameid,timestamp):
-        self.file_handler.write(frame)
-        if np.mod(frameid,5000) == 0: 
-            display('Wrote frame id - {0}'.format(frameid))
+        self._reserve(frame.nbytes)
+        self.file_handler.write(np.ascontiguousarray(frame))
+        self.data_nbytes += frame.nbytes
+        self._header_on_flush()
+    
+    def _write_frames(self, frames, records):
+        self._reserve(frames.nbytes)
+        self.file_handler.write(np.ascontiguousarray(frames))
+        self.data_nbytes += frames.nbytes
+        self._header_on_flush()
+    
+    def _release_file_handler(self):
+        if self.file_handler is not None:
+            self._update_header(self.file_frame_count)
+            self.file_handler.close() # truncates to the data
+            self.file_handler = None
         
+class CompressedWriter(FileWriter):
+    """Raw file (see raw_header) with every group of group_frames frames compressed on its own
+    with zstd or lz4 (numcodecs), optionally after a byte shuffle (shuffle, helps 16 bit frames).
+    Groups are compressed on a pool of compression_threads threads and appended in order,
+    the file ends with an index of the group offsets so frames can be read at random
+    (NeuCams.io RawReader). Without the index (crashed run) the groups can still be walked.
+    level: zstd level or lz4 acceleration, None is the codec default (fast).
+    The file is written in aligned blocks of buffer_mb, see BlockFile for direct_io, fadvise and fsync_mb.
+    """
+    options = ('codec', 'level', 'shuffle', 'group_frames', 'compression_threads',
+               'buffer_mb', 'direct_io', 'fadvise', 'fsync_mb')
+    uses_threads = True
+    
+    def __init__(self, filepath,
+                       frames_per_file = 0,
+                       codec = 'zstd',
+                       level = None,
+                       shuffle = True,
+                       group_frames = 1,
+                       compression_threads = 4,
+                       buffer_mb = 16,
+                       direct_io = False,
+                       fadvise = False,
+                       fsync_mb = 0,
+                       **kwargs):
+        if find_spec('numcodecs') is None:
+            raise ImportError('The compressed writer needs the numcodecs package.')
+        if codec not in RAW_CODECS:
+            display(f'CompressedWriter - unknown codec {codec}, using zstd.', level='warning')
+            codec = 'zstd'
+        self.codec = codec
+        self.level = level
+        self.filters = RAW_SHUFFLE if shuffle else 0
+        self.group_frames = max(1, group_frames)
+        self.compression_threads = compression_threads
+        self.block_params = {'block_mb': buffer_mb, 'direct': direct_io, 'fadvise': fadvise, 'fsync_mb': fsync_mb}
+        self.pool = None # created in the writer process
+        self.encode_stats = [0, 0, 0] # frames, raw bytes, compressed bytes
+        super().__init__(filepath = filepath,
+                         frames_per_file = frames_per_file,
+                         extension = 'dat',
+                         **kwargs)
+    
+    def _get_file_handler(self, filepath, frame = None):
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(self.compression_threads, thread_name_prefix = 'compress')
+        self.codecs = get_raw_codecs(self.codec, self.filters, frame.dtype.itemsize, self.level)
+        self.frame_shape = frame.shape
+        self.frame_dtype = frame.dtype
+        self.group = np.empty((self.group_frames, *frame.shape), dtype = frame.dtype)
+        self.group_count = 0
+        self.group_offsets = []
+        self.pending = deque()
+        display('Opening: '+ filepath)
+        file_handler = BlockFile(filepath, counters = self.counters, **self.block_params)
+        file_handler.write(self._pack_header())
+        return file_handler
+    
+    def _pack_header(self, frame_count = 0, index_offset = 0):
+        return pack_raw_header(self.frame_shape, self.frame_dtype, frame_count, self.codec,
+                               self.group_frames, self.filters, index_offset)
+    
+    def _compress(self, frames):
+        data = frames
+        for codec in self.codecs:
+            data = codec.encode(data)
+        return len(frames), data
+    
+    def _submit_group(self, frames):
+        self._write_done(2 * self.compression_threads - 1)
+        self.pending.append(self.pool.submit(self._compress, frames))
+    
+    def _write_done(self, max_pending):
+        """Appends the compressed groups in order, waits until at most max_pending are left"""
+        while self.pending and (len(self.pending) > max_pending or self.pending[0].done()):
+            n, data = self.pending.popleft().result()
+            self.group_offsets.append(self.file_handler.tell())
+            self.file_handler.write(RAW_GROUP_HEADER.pack(len(data), n))
+            self.file_handler.write(data)
+            self.encode_stats[2] += RAW_GROUP_HEADER.size + len(data)
+    
+    def _write(self, frame, frameid, timestamp):
+        self.group[self.group_count] = frame
+        self.group_count += 1
+        if self.group_count == self.group_frames:
+            self._submit_group(self.group)
+            self.group = np.empty_like(self.group)
+            self.group_count = 0
+        self.encode_stats[0] += 1
+        self.encode_stats[1] += frame.nbytes
+    
+    def _write_frames(self, frames, records):
+        i = 0
+        while self.group_count > 0 and i < len(frames): # completes the current group
+            self._write(frames[i], None, None)
+            i += 1
+        n = i + (len(frames) - i) // self.group_frames * self.group_frames
+        for start in range(i, n, self.group_frames):
+            self._submit_group(np.array(frames[start:start + self.group_frames])) # copied, the batch may be reused
+        self.encode_stats[0] += n - i
+        self.encode_stats[1] += frames[i:n].nbytes
+        for frame in frames[n:]:
+            self._write(frame, None, None)
+    
+    def _release_file_handler(self):
+        if self.file_handler is None:
+            return
+        if self.group_count > 0:
+            self._submit_group(self.group[:self.group_count])
+            self.group = np.empty_like(self.group)
+            self.group_count = 0
+        self._write_done(0)
+        index_offset = self.file_handler.tell()
+        self.file_handler.write(np.array(self.group_offsets + [index_offset], dtype = np.uint64))
+        self.file_handler.write_at(self._pack_header(self.file_frame_count, index_offset), 0)
+        self.file_handler.close()
+        self.file_handler = None
+    
+    def _close_run(self):
+        super()._close_run()
+        n_frames, raw_nbytes, file_nbytes = self.encode_stats
+        if n_frames > 0:
+            display(f'CompressedWriter - {self.codec}: {n_frames} frames, ratio {raw_nbytes / max(file_nbytes, 1):.2f}.')
+        self.encode_stats = [0, 0, 0]
+    
+    def run(self):
+        try:
+            super().run()
+        finally:
+            if self.pool is not None:
+                self.pool.shutdown()
+
+FFMPEG_CODECS = {'x264': ['-c:v', 'libx264'],
+                 'x264_lossless': ['-c:v', 'libx264', '-qp', '0'], # libx264rgb for color frames
+                 'x265': ['-c:v', 'libx265'],
+                 'ffv1': ['-c:v', 'ffv1', '-level', '3', '-slices', '16', '-slicecrc', '1'],
+                 'qsv': ['-c:v', 'h264_qsv', '-look_ahead', '1'],
+                 'nvenc': ['-c:v', 'h264_nvenc', '-preset', 'medium']}
+FFMPEG_16BIT_CODECS = ['ffv1'] # x264/x265 have no 16 bit gray format
+F_SETPIPE_SZ = 1031 # linux fcntl
+
 class FFMPEGWriter(FileWriter):
+    """Videos encoded by an ffmpeg process, one per file, reading raw frames from a pipe.
+    Frames (whole batches) are written straight from their buffers to the pipe, the pipe and
+    its write buffer are pipe_mb large.
+    codec (see FFMPEG_CODECS):
+        'x264', 'x265'   : lossy, compression is the crf, preset the x264/x265 preset
+        'x264_lossless'  : 8 bit only, color frames stay bgr (libx264rgb)
+        'ffv1'           : lossless, 8 and 16 bit (gray16le), uint16 frames always use it
+        'qsv', 'nvenc'   : intel/nvidia hardware h264 (also selected by hwaccel 'intel'/'nvidia')
+    threads: encoder threads, None lets ffmpeg decide.
+    The encoder fps (frames over the time spent writing to the pipe and draining the encoder
+    when a file is closed, not the time waiting for frames) is logged at the end of each run.
+    """
+    options = ('hwaccel', 'compression', 'codec', 'preset', 'threads', 'pipe_mb', 'ffmpeg_path')
+    uses_threads = True
     def __init__(self, filepath,
                        frames_per_file=0,
                        hwaccel = None,
                        frame_rate = None,
                        compression=17,
+                       codec = 'x264',
+                       preset = 'veryfast',
+                       threads = None,
+                       pipe_mb = 64,
+                       ffmpeg_path = 'ffmpeg',
                        **kwargs):
-                       
-        super().__init__(filepath,
-                         frames_per_file = frames_per_file,
-                         extension = 'avi')
-                         
         self.compression = compression
         if frame_rate is None:
             frame_rate = 0
         if frame_rate <= 0:
             frame_rate = 30.
         self.frame_rate = frame_rate
-        if hwaccel is None:
-            self.doutputs = {'-format':'h264',
-                             '-pix_fmt':'gray',
-                             '-vcodec':'libx264',
-                             '-threads':str(10),
-                             '-crf':str(self.compression)}
-        else:            
-            if hwaccel == 'intel':
-                if self.compression == 0:
-                    display('Using compression 17 for the intel Media SDK encoder')
-                    self.compression = 17
-                self.doutputs = {'-format':'h264',
-                                 '-pix_fmt':'yuv420p',#'gray',
-                                 '-vcodec':'h264_qsv',#'libx264',
-                                 '-global_quality':str(25), # specific to the qsv
-                                 '-look_ahead':str(1),
-                                 #preset='veryfast',#'ultrafast',
-                                 '-threads':str(1),
-                                 '-crf':str(self.compression)}
-            elif hwaccel == 'nvidia':
-                if self.compression == 0:
-                    display('Using compression 25 for the NVIDIA encoder')
-                    self.compression = 25
-                self.doutputs = {'-vcodec':'h264_nvenc',
-                                 '-pix_fmt':'yuv420p',
-                                 '-cq:v':str(self.compression),
-                                 '-threads':str(1),
-                                 '-preset':'medium'}
+        if hwaccel is not None:
+            codec = {'intel': 'qsv', 'nvidia': 'nvenc'}.get(hwaccel, codec)
+        if codec not in FFMPEG_CODECS:
+            display(f'FFMPEGWriter - unknown codec {codec}, using x264.', level='warning')
+            codec = 'x264'
+        if codec in ['qsv', 'nvenc'] and self.compression == 0:
+            self.compression = 25
+        self.codec = codec
         self.hwaccel = hwaccel
+        self.preset = preset
+        self.threads = threads
+        self.pipe_nbytes = int(pipe_mb * 2**20)
+        self.ffmpeg_path = ffmpeg_path
+        self.encode_stats = [0, 0., 0.] # frames, seconds writing to the pipe, seconds draining the encoder at close
+        super().__init__(filepath,
+                         frames_per_file = frames_per_file,
+                         extension = 'mkv',
+                         **kwargs)
     
     def set_video_settings(self,cam):
         ''' Sets camera specific variables - happens after camera load'''
@@ -313,36 +1306,101 @@ class FFMPEGWriter(FileWriter):
         if hasattr(cam,'nchan'):
             self.nchannels = cam.nchan
 
+    def _get_ffmpeg_args(self, filepath, frame):
+        height, width = frame.shape[:2]
+        color = frame.ndim == 3 and frame.shape[2] == 3
+        if frame.dtype == np.uint16 and self.codec not in FFMPEG_16BIT_CODECS:
+            display(f'FFMPEGWriter - {self.codec} can not encode 16 bit frames, using ffv1.', level='warning')
+            self.codec = 'ffv1'
+        codec = self.codec
+        if frame.dtype == np.uint16:
+            in_format = 'bgr48le' if color else 'gray16le'
+        else:
+            in_format = 'bgr24' if color else 'gray'
+        codec_args = FFMPEG_CODECS[codec]
+        if codec == 'ffv1':
+            out_format = {'bgr24': 'bgr0', 'bgr48le': 'gbrp16le'}.get(in_format, in_format)
+        elif codec == 'qsv':
+            out_format = 'nv12'
+        elif codec == 'x264_lossless' and color:
+            codec_args = ['-c:v', 'libx264rgb', *codec_args[2:]]
+            out_format = 'bgr24'
+        elif codec == 'nvenc' or color:
+            out_format = 'yuv420p'
+        else:
+            out_format = 'gray'
+        args = [self.ffmpeg_path, '-y', '-loglevel', 'error', '-nostdin',
+                '-f', 'rawvideo', '-pix_fmt', in_format, '-s', f'{width}x{height}', '-r', str(self.frame_rate),
+                '-i', 'pipe:0', *codec_args, '-pix_fmt', out_format]
+        if codec in ['x264', 'x265']:
+            args += ['-crf', str(self.compression), '-preset', self.preset]
+        elif codec == 'x264_lossless':
+            args += ['-preset', self.preset]
+        elif codec == 'qsv':
+            args += ['-global_quality', str(self.compression)]
+        elif codec == 'nvenc':
+            args += ['-cq:v', str(self.compression)]
+        if self.threads is not None:
+            args += ['-threads', str(self.threads)]
+        return args + [filepath]
+
     def _get_file_handler(self,filepath,frame = None):
         if frame is None:
             raise ValueError('[Recorder] Need to pass frame to open a file.')
-        if self.frame_rate is None:
-            self.frame_rate = 0
-        if self.frame_rate == 0:
+        if not self.frame_rate:
             display('Using 30Hz frame rate for ffmpeg')
             self.frame_rate = 30
-        
-        self.doutputs['-r'] =str(self.frame_rate)
-        self.dinputs = {'-r':str(self.frame_rate)}
-        
-        # does a check for the datatype, if uint16 then save compressed lossless
-        if frame.dtype in [np.uint16] and len(frame.shape) == 2:
-            filepath = filepath.rsplit(".",1)[0] + '.mov'
-            inputdict={'-pix_fmt':'gray16le',
-                      '-r':str(self.frame_rate)} # this is important
-            outputdict={'-c:v':'libopenjpeg',
-                       '-pix_fmt':'gray16le',
-                       '-r':str(self.frame_rate)}
-        else:
-            inputdict=self.dinputs
-            outputdict=self.doutputs
         display('Opening: '+ filepath)
-        return FFmpegWriter(filepath, inputdict=inputdict, outputdict=outputdict)
-            
+        process = subprocess.Popen(self._get_ffmpeg_args(filepath, frame), stdin = subprocess.PIPE,
+                                   stderr = subprocess.PIPE, bufsize = self.pipe_nbytes)
+        if fcntl is not None and sys.platform.startswith('linux'):
+            try:
+                fcntl.fcntl(process.stdin.fileno(), F_SETPIPE_SZ, self.pipe_nbytes)
+            except OSError: # above /proc/sys/fs/pipe-max-size
+                pass
+        self.encoder_failed = False
+        return process
+
+    def _write_frames(self, frames, records):
+        if self.encoder_failed:
+            return
+        t = time.perf_counter()
+        try:
+            self.file_handler.stdin.write(np.ascontiguousarray(frames))
+        except (BrokenPipeError, OSError):
+            self.encoder_failed = True
+            display(f'FFMPEGWriter - ffmpeg stopped, frames of {self.current_filepath} are lost: '
+                    f'{self.file_handler.stderr.read().decode(errors = "replace").strip()}', level='error')
+        self.encode_stats[0] += len(frames)
+        self.encode_stats[1] += time.perf_counter() - t
+
     def _write(self,frame,frameid,timestamp):
-        self.file_handler.writeFrame(frame)
+        self._write_frames(frame[None], None)
+
+    def _release_file_handler(self):
+        if self.file_handler is None:
+            return
+        t = time.perf_counter()
+        try:
+            self.file_handler.stdin.close()
+        except OSError:
+            pass
+        error = self.file_handler.stderr.read().decode(errors = 'replace').strip()
+        if self.file_handler.wait() != 0 and not self.encoder_failed:
+            display(f'FFMPEGWriter - ffmpeg failed on {self.current_filepath}: {error}', level='error')
+        self.encode_stats[2] += time.perf_counter() - t
+        self.file_handler = None
+
+    def _close_run(self):
+        super()._close_run()
+        n_frames, write_time, drain_time = self.encode_stats
+        if n_frames > 0 and write_time + drain_time > 0:
+            display(f'FFMPEGWriter - {self.codec}: {n_frames} frames encoded at {n_frames / (write_time + drain_time):.0f} fps '
+                    f'({write_time:.1f} s writing to the pipe, {drain_time:.1f} s draining the encoder).')
+        self.encode_stats = [0, 0., 0.]
 
 class OpenCVWriter(FileWriter):
+    options = ('fourcc',)
     def __init__(self, filepath,
                        frames_per_file = 0,
                        fourcc = 'XVID', #'X264'
@@ -355,7 +1413,8 @@ class OpenCVWriter(FileWriter):
         self.h = None
         super().__init__(filepath,
                          extension = 'avi',
-                         frames_per_file=frames_per_file)
+                         frames_per_file=frames_per_file,
+                         **kwargs)
         
     def _release_file_handler(self):
         if not self.file_handler is None:
@@ -373,3 +1432,115 @@ class OpenCVWriter(FileWriter):
         # if frame.ndim < 3 or frame.shape[2] == 1:
             # frame = cv2.cvtColor(frame,cv2.COLOR_GRAY2RGB)
         self.file_handler.write(frame)
+
+class ZarrWriter(FileWriter):
+    """Frames and their metadata in a zarr group ({file}.zarr folder):
+        frames            (n_frames, height, width, n_chan), chunks of chunk_frames frames
+        metadata/{field}  one column per FRAME_METADATA_DTYPE field, written when the file is closed
+    Chunks are compressed with blosc (cname 'zstd' or 'lz4', clevel, 'bitshuffle', 'shuffle' or
+    'noshuffle') on a pool of compression_threads threads, several chunks are compressed and
+    written at once. Frames are buffered until a chunk is full so chunk writes never overlap.
+    The .meta.npy sidecar is written as for the other writers.
+    zarr is imported in the writer process: it starts threads, a process forked after that can hang.
+    """
+    options = ('chunk_frames', 'cname', 'clevel', 'shuffle', 'compression_threads')
+    uses_threads = True
+    grow_chunks = 1024 # the frames array grows by that many chunks (no data is allocated)
+    
+    def __init__(self, filepath,
+                       frames_per_file = 0,
+                       chunk_frames = 32,
+                       cname = 'zstd',
+                       clevel = 3,
+                       shuffle = 'bitshuffle',
+                       compression_threads = 4,
+                       **kwargs):
+        if find_spec('zarr') is None:
+            raise ImportError('The zarr writer needs the zarr package.')
+        self.chunk_frames = chunk_frames
+        self.cname = cname
+        self.clevel = clevel
+        self.shuffle = shuffle
+        self.compression_threads = compression_threads
+        self.pool = None # created in the writer process
+        super().__init__(filepath,
+                         extension = 'zarr',
+                         frames_per_file = frames_per_file,
+                         **kwargs)
+    
+    def _get_file_handler(self, filepath, frame = None):
+        import zarr
+        from zarr.codecs import BloscCodec
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(self.compression_threads, thread_name_prefix = 'zarr')
+        display('Opening: '+ filepath)
+        group = zarr.open_group(filepath, mode = 'w')
+        shape = frame.shape if frame.ndim == 3 else (*frame.shape, 1)
+        self.capacity = self.frames_per_file if self.frames_per_file > 0 else self.chunk_frames * self.grow_chunks
+        self.frames_array = group.create_array('frames', shape = (self.capacity, *shape),
+                                               chunks = (self.chunk_frames, *shape), dtype = frame.dtype,
+                                               compressors = BloscCodec(cname = self.cname, clevel = self.clevel,
+                                                                        shuffle = self.shuffle))
+        group.attrs.update({'version': VERSION, 'cname': self.cname, 'clevel': self.clevel, 'shuffle': self.shuffle})
+        self.chunk_buffer = np.empty((self.chunk_frames, *shape), dtype = frame.dtype)
+        self.chunk_buffer_count = 0 # frames in self.chunk_buffer
+        self.submitted_count = 0 # frames sent to the pool
+        self.pending = deque()
+        return group
+    
+    def _submit_chunk(self):
+        """Compresses and writes the buffered frames on the pool"""
+        start, stop = self.submitted_count, self.submitted_count + self.chunk_buffer_count
+        if stop > self.capacity: # resizing while chunks are written is not safe
+            self._wait_pending(0)
+            self.capacity += self.chunk_frames * self.grow_chunks
+            self.frames_array.resize((self.capacity, *self.frames_array.shape[1:]))
+        self._wait_pending(2 * self.compression_threads - 1)
+        frames = self.chunk_buffer[:self.chunk_buffer_count]
+        self.pending.append(self.pool.submit(self.frames_array.__setitem__, slice(start, stop), frames))
+        self.chunk_buffer = np.empty_like(self.chunk_buffer)
+        self.submitted_count = stop
+        self.chunk_buffer_count = 0
+    
+    def _wait_pending(self, max_pending):
+        while len(self.pending) > max_pending:
+            self.pending.popleft().result()
+    
+    def _write(self, frame, frameid, timestamp):
+        self.chunk_buffer[self.chunk_buffer_count] = frame.reshape(self.chunk_buffer.shape[1:])
+        self.chunk_buffer_count += 1
+        if self.chunk_buffer_count == self.chunk_frames:
+            self._submit_chunk()
+    
+    def _write_frames(self, frames, records):
+        frames = frames.reshape(len(frames), *self.chunk_buffer.shape[1:])
+        i = 0
+        while i < len(frames):
+            n = min(len(frames) - i, self.chunk_frames - self.chunk_buffer_count)
+            self.chunk_buffer[self.chunk_buffer_count:self.chunk_buffer_count + n] = frames[i:i + n]
+            self.chunk_buffer_count += n
+            i += n
+            if self.chunk_buffer_count == self.chunk_frames:
+                self._submit_chunk()
+    
+    def _release_file_handler(self):
+        if self.file_handler is None:
+            return
+        if self.chunk_buffer_count > 0:
+            self._submit_chunk()
+        self._wait_pending(0)
+        self.frames_array.resize((self.submitted_count, *self.frames_array.shape[1:]))
+        records = self.metadata_log.records()
+        metadata = self.file_handler.require_group('metadata')
+        for name in records.dtype.names:
+            column = metadata.create_array(name, shape = records[name].shape, dtype = records[name].dtype,
+                                           chunks = (max(1, min(len(records), 65536)),))
+            column[:] = records[name]
+        self.file_handler = None
+    
+    def run(self):
+        try:
+            super().run()
+        finally:
+            if self.pool is not None:
+                self.pool.shutdown()
@@ -0,0 +1,89 @@
+"""frame_metadata.py
+Fixed-dtype per-frame metadata records and the sidecar files written next to every recording.
+A sidecar is a structured .npy ({file}.meta.npy), load it with np.load(path, mmap_mode='r')
+and use the fields as columns (records['frame_id'], records['host_time_ns'], ...).
+"""
+from os.path import splitext
+import numpy as np
+
+FRAME_METADATA_DTYPE = np.dtype([('frame_id', np.int64),      # camera frame id
+                                 ('timestamp', np.float64),   # hardware timestamp, as reported by the driver
+                                 ('host_time_ns', np.int64),  # time.monotonic_ns() when the handler got the frame
+                                 ('host_timestamp_ns', np.int64), # timestamp mapped to the host monotonic clock (clock_sync)
+                                 ('run_nr', np.int32),
+                                 ('file_index', np.int32),    # index of the file in the run (0 is the first file)
+                                 ('file_offset', np.int64),   # frame index in that file
+                                 ('flags', np.uint8)])
+
+# flags
+FRAME_INCOMPLETE = 1    # the driver reported an incomplete/corrupt frame
+FRAMES_DROPPED = 2      # frames are missing before this one
+
+SIDECAR_SUFFIX = '.meta.npy'
+
+def get_sidecar_filepath(filepath):
+    return splitext(filepath)[0] + SIDECAR_SUFFIX
+
+def make_metadata_records(cam_metadata):
+    """Record array from the driver (frame_id, timestamp[, flags]) tuples of a batch of frames"""
+    records = np.zeros(len(cam_metadata), dtype = FRAME_METADATA_DTYPE)
+    for record, meta in zip(records, cam_metadata):
+        record['frame_id'], record['timestamp'] = meta[:2]
+        if len(meta) > 2:
+            record['flags'] = meta[2]
+    return records
+
+class FrameMetadataLog:
+    """Collects the metadata of the frames written to one file, in preallocated blocks,
+    and saves them in bulk as a sidecar when the file is closed."""
+    block_size = 4096
+
+    def __init__(self):
+        self.blocks = []
+        self.n = 0
+
+    def __len__(self):
+        return self.n
+
+    def append(self, metadata, file_index, file_offset):
+        """metadata: (frame_id, timestamp[, host_time_ns, run_nr, flags]) tuple of a frame queued with save()"""
+        i = self.n % self.block_size
+        if i == 0:
+            self.blocks.append(np.zeros(self.block_size, dtype = FRAME_METADATA_DTYPE))
+        record = self.blocks[-1][i]
+        record['frame_id'], record['timestamp'] = metadata[:2]
+        if len(metadata) >= 5:
+            record['host_time_ns'], record['run_nr'], record['flags'] = metadata[2:5]
+        record['file_index'] = file_index
+        record['file_offset'] = file_offset
+        self.n += 1
+
+    def extend(self, records, file_index, file_offset):
+        """Appends a batch of records, file_offset is the offset of the first one"""
+        records = records.copy()
+        records['file_index'] = file_index
+        records['file_offset'] = np.arange(file_offset, file_offset + len(records))
+        i = self.n % self.block_size
+        if i > 0: # fill the current block first
+            n = min(len(records), self.block_size - i)
+            self.blocks[-1][i:i + n] = records[:n]
+            records = records[n:]
+            self.n += n
+        for start in range(0, len(records), self.block_size):
+            block = np.zeros(self.block_size, dtype = FRAME_METADATA_DTYPE)
+            chunk = records[start:start + self.block_size]
+            block[:len(chunk)] = chunk
+            self.blocks.append(block)
+            self.n += len(chunk)
+
+    def records(self):
+        if not self.blocks:
+            return np.zeros(0, dtype = FRAME_METADATA_DTYPE)
+        return np.concatenate(self.blocks)[:self.n]
+
+    def save(self, filepath):
+        np.save(get_sidecar_filepath(filepath), self.records())
+
+    def clear(self):
+        self.blocks = []
+        self.n = 0
@@ -0,0 +1,207 @@
+"""frame_sync.py
+Live cross-camera frame matching, runs in the main process.
+The writer of every CameraHandler streams (frame_id, host timestamp, device timestamp) of the frames
+it wrote through the handler's sync_log (SyncLog); the coordinator matches the frames of all cameras to the ticks
+(frames) of a reference camera and appends the rows to a table next to the reference recording:
+    {reference run filepath}_sync.csv
+    timestamp_ns,<reference>,<cam 2>,...
+One row per reference frame, the camera frame id of every camera, -1 when no frame of that
+camera is within the tolerance. Recording.frame_index turns the ids into frame indices.
+"""
+import os
+import time
+import queue
+from multiprocessing import Queue, Event, Value
+import numpy as np
+
+from NeuCams.utils import display
+
+SYNC_TIMESTAMPS = {'host': 1,    # device timestamps mapped to the host monotonic clock (clock_sync)
+                   'device': 2}  # raw hardware timestamps, only when the cameras share a clock (PTP, common trigger)
+
+class SyncLog:
+    """Sync rows of the frames of one camera, sent by its writer(s) once the frames are written
+    (dropped and spilled frames are not in the recording, they get no row).
+    Every writer ends each of its runs with ('end', n_frames written), a writer pool has n_writers of them.
+    enabled is set by the coordinator, rows that do not fit in the queue are counted in dropped."""
+    def __init__(self, n_writers = 1, maxsize = 1024):
+        self.n_writers = n_writers
+        self.enabled = Event()
+        self.queue = Queue(maxsize = maxsize)
+        self.dropped = Value('i', 0)
+
+    def send(self, records):
+        """FRAME_METADATA_DTYPE records of written frames"""
+        if not self.enabled.is_set() or not len(records):
+            return
+        sync = np.empty((len(records), 3), dtype = np.int64)
+        sync[:, 0] = records['frame_id'] # Recording.frame_index gives the index in the recording
+        sync[:, 1] = records['host_timestamp_ns']
+        sync[:, 2] = np.rint(records['timestamp'] * 1e9)
+        try:
+            self.queue.put_nowait(('frames', sync))
+        except queue.Full: # coordinator not reading
+            with self.dropped.get_lock():
+                self.dropped.value += len(records)
+
+    def end(self, n_frames):
+        if not self.enabled.is_set():
+            return
+        try:
+            self.queue.put_nowait(('end', n_frames))
+        except queue.Full:
+            pass
+
+class _CamStream:
+    def __init__(self, handler):
+        self.handler = handler
+        self.sync_log = handler.sync_log
+        self.name = handler.cam_dict.get('description', '')
+        self.frames = np.zeros((0, 2), dtype = np.int64) # pending (frame_id, time_ns)
+        self.latest = None
+        self.ended = False
+        self.last_seen = 0
+        self.n_matched = 0
+        self.n_ends = 0 # writers that ended the run (writer pool)
+        self.n_run_frames = 0
+
+    def append(self, frames):
+        """The workers of a writer pool write their chunks in parallel, their frames are merged by time"""
+        self.frames = np.concatenate([self.frames, frames])
+        if self.latest is not None and frames[0, 1] < self.latest:
+            self.frames = self.frames[np.argsort(self.frames[:, 1], kind = 'stable')]
+        self.latest = int(self.frames[-1, 1])
+
+    def end(self, n_frames):
+        """End of run of one writer, the stream ends with the last writer of a run that wrote frames"""
+        self.n_ends += 1
+        self.n_run_frames += n_frames
+        if self.n_ends >= self.sync_log.n_writers:
+            self.ended = self.ended or self.n_run_frames > 0
+            self.n_ends = 0
+            self.n_run_frames = 0
+
+    def is_behind(self, t, now):
+        """True if frames up to t (ns) may still arrive from this camera"""
+        if self.ended or now - self.last_seen > self.max_lag_ns:
+            return np.zeros(len(t), dtype = bool)
+        if self.latest is None:
+            return np.ones(len(t), dtype = bool)
+        return self.latest < t
+
+class FrameSyncCoordinator:
+    """Matches frames across cameras by timestamp, incrementally while recording.
+    handlers: CameraHandlers, the first one (or the one with description == reference) gives the ticks
+    tolerance_ms: max distance between a tick and a matched frame
+    max_lag: s, a camera that did not send frames for that long is not waited for
+    timestamp: 'host' or 'device' (see SYNC_TIMESTAMPS)
+    Call process() periodically (GUI timer), close() at the end.
+    """
+    def __init__(self, handlers, reference = None, tolerance_ms = 2., max_lag = 1., timestamp = 'host'):
+        self.streams = [_CamStream(handler) for handler in handlers]
+        names = [s.name for s in self.streams]
+        self.reference = self.streams[names.index(reference)] if reference in names else self.streams[0]
+        self.others = [s for s in self.streams if s is not self.reference]
+        self.tolerance_ns = int(tolerance_ms * 1e6)
+        if timestamp not in SYNC_TIMESTAMPS:
+            display(f'Frame sync - unknown timestamp {timestamp}, using host.', level='warning')
+            timestamp = 'host'
+        self.column = SYNC_TIMESTAMPS[timestamp]
+        self.timestamp = timestamp
+        for s in self.streams:
+            s.max_lag_ns = int(max_lag * 1e9)
+            s.sync_log.enabled.set()
+        self.table = None
+        self.n_rows = 0
+        display(f'Frame sync - reference {self.reference.name}, tolerance {tolerance_ms} ms, {timestamp} timestamps.')
+
+    def process(self):
+        now = time.monotonic_ns()
+        for s in self.streams:
+            self._read_stream(s, now)
+        if self.table is not None:
+            self._match(now)
+            if self.reference.ended and not len(self.reference.frames):
+                self._close_table()
+
+    def _read_stream(self, s, now):
+        while True:
+            try:
+                message = s.sync_log.queue.get_nowait()
+            except queue.Empty:
+                return
+            if message[0] == 'frames':
+                if s.ended: # new run
+                    s.ended = False
+                    s.frames = s.frames[:0]
+                    s.latest = None
+                if s is self.reference and self.table is None:
+                    self._open_table()
+                s.append(message[1][:, [0, self.column]])
+                s.last_seen = now
+            elif message[0] == 'end':
+                s.end(message[1])
+
+    def _match(self, now):
+        ref = self.reference
+        if not len(ref.frames):
+            return
+        t = ref.frames[:, 1]
+        waiting = np.zeros(len(t), dtype = bool)
+        for s in self.others:
+            waiting |= s.is_behind(t + self.tolerance_ns, now)
+        n = int(np.argmax(waiting)) if waiting.any() else len(t)
+        if n == 0:
+            return
+        t = t[:n]
+        rows = np.full((n, 2 + len(self.others)), -1, dtype = np.int64)
+        rows[:, 0] = t
+        rows[:, 1] = ref.frames[:n, 0]
+        for j, s in enumerate(self.others):
+            if not len(s.frames):
+                continue
+            st = s.frames[:, 1]
+            i = np.clip(np.searchsorted(st, t), 1, len(st) - 1) if len(st) > 1 else np.zeros(n, dtype = int)
+            if len(st) > 1: # nearest of the two neighbours
+                i -= (t - st[i - 1]) < (st[i] - t)
+            matched = np.abs(st[i] - t) <= self.tolerance_ns
+            rows[matched, 2 + j] = s.frames[i[matched], 0]
+            s.n_matched += int(matched.sum())
+            # frames before the last tick can not be matched anymore
+            s.frames = s.frames[np.searchsorted(st, t[-1] - self.tolerance_ns):]
+        ref.frames = ref.frames[n:]
+        np.savetxt(self.table, rows, fmt = '%d', delimiter = ',')
+        self.table.flush()
+        self.n_rows += n
+
+    def _open_table(self):
+        filepath = self.reference.handler.get_filepath() + '_sync.csv'
+        os.makedirs(os.path.dirname(filepath), exist_ok = True)
+        self.table = open(filepath, 'w')
+        self.table.write(f'# tolerance_ms: {self.tolerance_ns / 1e6}, timestamps: {self.timestamp}\n')
+        for s in [self.reference] + self.others:
+            self.table.write(f'# {s.name}: {s.handler.get_filepath()}\n')
+        self.table.write(','.join(['timestamp_ns'] + [s.name for s in [self.reference] + self.others]) + '\n')
+        self.n_rows = 0
+        for s in self.others:
+            s.n_matched = 0
+        display(f'Frame sync - writing {filepath}')
+
+    def _close_table(self):
+        if self.table is None:
+            return
+        self.table.close()
+        self.table = None
+        matched = ', '.join(f'{s.name} {s.n_matched}' for s in self.others)
+        display(f'Frame sync - {self.n_rows} ticks, matched frames: {matched}.')
+
+    def close(self):
+        now = time.monotonic_ns()
+        for s in self.streams:
+            self._read_stream(s, now)
+            s.ended = True
+        if self.table is not None:
+            self._match(now)
+        self._close_table()
+        for s in self.streams:
+            s.sync_log.enabled.clear()
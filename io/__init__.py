@@ -0,0 +1,2 @@
+from NeuCams.io.readers import open_file, RawReader, TiffReader, VideoReader, ZarrReader
+from NeuCams.io.recording import open_recording, find_runs, Recording
@@ -0,0 +1,306 @@
+"""readers.py
+Lazy readers for one recording file (or zarr folder), all with the same array-like interface:
+len(reader), reader.shape (n_frames, height, width, n_chan), reader.dtype and
+reader[i] / reader[start:stop] returning (n, height, width, n_chan) arrays.
+Nothing is read before it is indexed.
+"""
+import re
+import os
+from os.path import basename, isfile
+import numpy as np
+
+from NeuCams.raw_header import read_raw_header, get_raw_codecs, RAW_GROUP_HEADER
+from NeuCams.frame_metadata import FRAME_METADATA_DTYPE, get_sidecar_filepath
+
+# format in the name of the raw files written before the raw header: {name}_{n_chan}_{H}_{W}_{dtype}[_{i}].dat
+LEGACY_RAW_NAME = re.compile(r'_(\d+)_(\d+)_(\d+)_([a-z]+\d+)(?:_\d+)?\.dat$')
+# ffmpeg codec tags of the video pixel formats (cv2.CAP_PROP_CODEC_PIXEL_FORMAT)
+GRAY_PIXEL_FORMATS = [b'Y800', b'GREY', b'Y8  ', b'Y1\x00\x10'] # gray, gray16le
+
+def _is_high_bit_depth(pixel_format):
+    """ffmpeg raw tags end with the bit depth: Y1\\0\\x10 (gray16le), G3\\0\\x10 (gbrp16le), BGR0 (bgr48le)"""
+    if pixel_format[2] == 0:
+        return pixel_format[3] > 8
+    return pixel_format[:3] in [b'BGR', b'RGB'] and pixel_format[3] in [48, 64]
+
+class FileReader:
+    """Base class, subclasses set self.shape (n_frames, height, width, n_chan) and self.dtype
+    and implement _read(start, stop)"""
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self._metadata = None
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        if isinstance(index, tuple): # the first axis picks the frames to read, the others index the frames read
+            if not len(index) or index[0] is Ellipsis:
+                return self[:][index]
+            frames = self[index[0]]
+            return frames[index[1:]] if isinstance(index[0], (int, np.integer)) else frames[(slice(None), *index[1:])]
+        if isinstance(index, (int, np.integer)):
+            if index < 0:
+                index += len(self)
+            if not 0 <= index < len(self):
+                raise IndexError(f'frame {index} out of range ({len(self)} frames)')
+            return self._read(index, index + 1)[0]
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step == 1:
+                return self._read(start, stop)
+            index = np.arange(start, stop, step)
+        index = np.asarray(index)
+        return np.stack([self[int(i)] for i in index]) if len(index) else self._read(0, 0)
+
+    def _read(self, start, stop):
+        raise NotImplementedError
+
+    @property
+    def metadata(self):
+        """FRAME_METADATA_DTYPE records, from the .meta.npy sidecar when there is one"""
+        if self._metadata is None:
+            sidecar = get_sidecar_filepath(self.filepath)
+            if isfile(sidecar):
+                self._metadata = np.load(sidecar, mmap_mode = 'r')
+            else:
+                self._metadata = self._default_metadata()
+        return self._metadata
+
+    def _default_metadata(self):
+        records = np.zeros(len(self), dtype = FRAME_METADATA_DTYPE)
+        records['frame_id'] = np.arange(len(self))
+        records['timestamp'] = np.nan
+        records['file_offset'] = np.arange(len(self))
+        return records
+
+    def close(self):
+        pass
+
+class RawReader(FileReader):
+    """BinaryWriter files, memory mapped. Files without header get their format from the filename.
+    CompressedWriter files (codec in the header) are read group by group through their index,
+    the last decompressed group is kept for sequential reads."""
+    def __init__(self, filepath):
+        super().__init__(filepath)
+        with open(filepath, 'rb') as f:
+            header = read_raw_header(f)
+        if header is None:
+            header = self._legacy_format(filepath)
+        height, width, n_chan = header['shape']
+        self.dtype = header['dtype']
+        self.file = None
+        if header.get('codec'):
+            self._init_groups(header)
+            return
+        frame_nbytes = height * width * n_chan * header['dtype'].itemsize
+        n_frames = (os.path.getsize(filepath) - header['header_size']) // frame_nbytes
+        if header['frame_count'] is not None:
+            n_frames = min(n_frames, header['frame_count']) # preallocated space after the frames
+        self.shape = (int(n_frames), height, width, n_chan)
+        self.data = np.memmap(filepath, dtype = self.dtype, mode = 'r', offset = header['header_size'],
+                              shape = self.shape) if n_frames > 0 else np.zeros(self.shape, dtype = self.dtype)
+
+    def _init_groups(self, header):
+        self.data = None
+        self.file = open(self.filepath, 'rb')
+        self.group_frames = header['group_frames']
+        self.codecs = get_raw_codecs(header['codec'], header['filters'], self.dtype.itemsize)[::-1]
+        if header['index_offset'] > 0:
+            n_groups = -(-header['frame_count'] // self.group_frames)
+            self.file.seek(header['index_offset'])
+            self.offsets = np.fromfile(self.file, dtype = np.uint64, count = n_groups + 1).astype(np.int64)
+            n_frames = header['frame_count']
+        else: # not closed, walks the complete groups
+            offsets, n_frames = [], 0
+            position, size = header['header_size'], os.path.getsize(self.filepath)
+            while position + RAW_GROUP_HEADER.size <= size:
+                self.file.seek(position)
+                nbytes, n = RAW_GROUP_HEADER.unpack(self.file.read(RAW_GROUP_HEADER.size))
+                if n == 0 or position + RAW_GROUP_HEADER.size + nbytes > size:
+                    break
+                offsets.append(position)
+                n_frames += n
+                position += RAW_GROUP_HEADER.size + nbytes
+            self.offsets = np.array(offsets + [position], dtype = np.int64)
+        self.shape = (int(n_frames), *header['shape'])
+        self.cached_group = (None, None)
+
+    @staticmethod
+    def _legacy_format(filepath):
+        match = LEGACY_RAW_NAME.search(basename(filepath))
+        if match is None:
+            raise ValueError(f'{filepath} has no raw header and no format in its name.')
+        n_chan, height, width, dtype = match.groups()
+        return {'header_size': 0, 'shape': (int(height), int(width), int(n_chan)),
+                'dtype': np.dtype(dtype), 'frame_count': None} # unknown, the file size tells
+
+    def _read_group(self, i):
+        if self.cached_group[0] != i:
+            self.file.seek(self.offsets[i])
+            nbytes, n = RAW_GROUP_HEADER.unpack(self.file.read(RAW_GROUP_HEADER.size))
+            data = self.file.read(nbytes)
+            for codec in self.codecs:
+                data = codec.decode(data)
+            self.cached_group = (i, np.frombuffer(data, dtype = self.dtype).reshape(n, *self.shape[1:]))
+        return self.cached_group[1]
+
+    def _read(self, start, stop):
+        if self.data is not None:
+            return self.data[start:stop]
+        out = np.empty((stop - start, *self.shape[1:]), dtype = self.dtype)
+        for i in range(start // self.group_frames, -(-stop // self.group_frames)):
+            group_start = i * self.group_frames
+            group = self._read_group(i)
+            first, last = max(start, group_start), min(stop, group_start + len(group))
+            out[first - start:last - start] = group[first - group_start:last - group_start]
+        return out
+
+    def close(self):
+        self.data = None
+        if self.file is not None:
+            self.file.close()
+
+class TiffReader(FileReader):
+    """TiffWriter files, one frame per page. The page offsets are read once, uncompressed
+    contiguous pages are then read straight from a memory map."""
+    def __init__(self, filepath):
+        super().__init__(filepath)
+        import tifffile
+        self.tif = tifffile.TiffFile(filepath)
+        pages = list(self.tif.pages)
+        first = pages[0]
+        self.dtype = np.dtype(first.dtype)
+        height, width = first.shape[:2]
+        n_chan = first.shape[2] if len(first.shape) > 2 else 1
+        self.shape = (len(pages), height, width, n_chan)
+        self.descriptions = [getattr(page, 'description', '') for page in pages]
+        self.offsets = None
+        if all(page.is_contiguous for page in pages):
+            self.offsets = np.array([page.dataoffsets[0] for page in pages], dtype = np.int64)
+            self.mmap = np.memmap(filepath, dtype = np.uint8, mode = 'r')
+            self._byteorder = self.tif.byteorder
+        self.pages = pages
+
+    def _read(self, start, stop):
+        out = np.empty((stop - start, *self.shape[1:]), dtype = self.dtype)
+        frame_nbytes = int(np.prod(self.shape[1:])) * self.dtype.itemsize
+        for i in range(start, stop):
+            if self.offsets is not None:
+                frame = self.mmap[self.offsets[i]:self.offsets[i] + frame_nbytes]
+                out[i - start] = frame.view(self.dtype.newbyteorder(self._byteorder)).reshape(self.shape[1:])
+            else:
+                out[i - start] = self.pages[i].asarray().reshape(self.shape[1:])
+        return out
+
+    def _default_metadata(self):
+        """frame ids and timestamps from the page descriptions (id:{frame_id};timestamp:{timestamp})"""
+        records = super()._default_metadata()
+        for i, description in enumerate(self.descriptions):
+            fields = dict(item.split(':', 1) for item in description.split(';') if ':' in item)
+            if 'id' in fields:
+                records['frame_id'][i] = int(fields['id'])
+            if 'timestamp' in fields:
+                records['timestamp'][i] = float(fields['timestamp'])
+        return records
+
+    def close(self):
+        self.tif.close()
+        self.mmap = None
+
+class VideoReader(FileReader):
+    """OpenCVWriter/FFMPEGWriter videos (.avi, .mkv) through cv2.VideoCapture. Reading forward is sequential,
+    going back seeks (exact for intra-only codecs, up to the previous keyframe otherwise).
+    Frames come back in their native format: gray sources (8 or 16 bit) as one channel, color as bgr.
+    Sources OpenCV can only convert to 8 bit (16 bit color) raise a ValueError."""
+    def __init__(self, filepath):
+        super().__init__(filepath)
+        import cv2
+        self.cv2 = cv2
+        self.capture = self._open(False)
+        n_frames = int(self.capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        ret, frame = self.capture.read()
+        if not ret:
+            raise ValueError(f'Could not read {filepath}')
+        pixel_format = (int(self.capture.get(getattr(cv2, 'CAP_PROP_CODEC_PIXEL_FORMAT', -1))) & 0xFFFFFFFF).to_bytes(4, 'little')
+        if _is_high_bit_depth(pixel_format) and frame.dtype != np.uint16:
+            raise ValueError(f'{filepath}: OpenCV can only read this {pixel_format} video converted to 8 bit.')
+        self.convert_rgb = False
+        if pixel_format not in GRAY_PIXEL_FORMATS:
+            # yuv/bgr sources: bgr, unless the decoded colors are all gray (x264 gray streams are 4:2:0 with neutral chroma)
+            luma = frame
+            rgb_capture = self._open(True)
+            ret, frame = rgb_capture.read()
+            if luma.ndim == 2 and frame.ndim == 3 and (frame == luma[..., None]).all():
+                rgb_capture.release()
+                frame = luma
+            else:
+                self.capture.release()
+                self.capture = rgb_capture
+                self.convert_rgb = True
+        self.position = 1
+        frame = frame.reshape(*frame.shape[:2], -1)
+        self.dtype = frame.dtype
+        self.shape = (n_frames, *frame.shape[:2], frame.shape[2] if self.convert_rgb else 1) # mono: one channel
+
+    def _open(self, convert_rgb):
+        capture = self.cv2.VideoCapture(self.filepath)
+        if not capture.isOpened():
+            raise ValueError(f'Could not open {self.filepath}')
+        capture.set(self.cv2.CAP_PROP_CONVERT_RGB, int(convert_rgb))
+        return capture
+
+    def _read(self, start, stop):
+        out = np.empty((stop - start, *self.shape[1:]), dtype = self.dtype)
+        if start != self.position:
+            self.capture.set(self.cv2.CAP_PROP_POS_FRAMES, start)
+        for i in range(stop - start):
+            ret, frame = self.capture.read()
+            if not ret:
+                raise IndexError(f'Could not read frame {start + i} of {self.filepath}')
+            out[i] = frame.reshape(*self.shape[1:3], -1)[..., :self.shape[3]] # mono: one channel
+        self.position = stop
+        return out
+
+    def close(self):
+        self.capture.release()
+
+class ZarrReader(FileReader):
+    """ZarrWriter groups, chunks are only decompressed when indexed"""
+    def __init__(self, filepath):
+        super().__init__(filepath)
+        import zarr
+        self.group = zarr.open_group(filepath, mode = 'r')
+        self.frames = self.group['frames']
+        self.dtype = np.dtype(self.frames.dtype)
+        self.shape = tuple(self.frames.shape)
+
+    def _read(self, start, stop):
+        return self.frames[start:stop]
+
+    def _default_metadata(self):
+        """metadata columns stored in the group"""
+        if 'metadata' not in self.group:
+            return super()._default_metadata()
+        columns = self.group['metadata']
+        records = np.zeros(len(self), dtype = FRAME_METADATA_DTYPE)
+        for name in FRAME_METADATA_DTYPE.names:
+            if name in columns:
+                records[name] = columns[name][:]
+        return records
+
+READERS = {'.dat': RawReader,
+           '.tif': TiffReader,
+           '.tiff': TiffReader,
+           '.avi': VideoReader,
+           '.mov': VideoReader,
+           '.mp4': VideoReader,
+           '.mkv': VideoReader,
+           '.zarr': ZarrReader}
+
+def open_file(filepath):
+    """Reader for one file, from its extension"""
+    extension = os.path.splitext(filepath)[1].lower()
+    if extension not in READERS:
+        raise ValueError(f'No reader for {extension} files ({filepath})')
+    return READERS[extension](filepath)
@@ -0,0 +1,170 @@
+"""recording.py
+A run split over several files (frames_per_file rollover, writer pool chunks) as one lazy array.
+"""
+import re
+import json
+import glob
+from os.path import basename, dirname, join, splitext, isfile, exists
+import numpy as np
+
+from NeuCams.io.readers import open_file
+from NeuCams.frame_metadata import get_sidecar_filepath
+
+FILE_INDEX = re.compile(r'^(.*)_(\d+)$') # {filepath}_{i}.extension (FileWriter.get_complete_filepath)
+
+class Recording:
+    """Files of one run in frame order, indexed like one (n_frames, height, width, n_chan) array.
+    recording[i], recording[start:stop] and recording[start:stop, y, x] only read the frames asked for (across files),
+    iter_chunks() reads the run in blocks, frame_index()/timestamp_index() look frames up
+    in the metadata of all files.
+    """
+    def __init__(self, filepaths):
+        if not len(filepaths):
+            raise ValueError('A recording needs at least one file.')
+        self.filepaths = list(filepaths)
+        self.files = [open_file(filepath) for filepath in self.filepaths]
+        self.starts = np.cumsum([0] + [len(f) for f in self.files])
+        first = self.files[0]
+        self.dtype = first.dtype
+        self.shape = (int(self.starts[-1]), *first.shape[1:])
+        self._metadata = None
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return f'Recording({len(self.files)} files, shape {self.shape}, {self.dtype})'
+
+    def __getitem__(self, index):
+        if isinstance(index, tuple): # the first axis picks the frames to read, the others index the frames read
+            if not len(index) or index[0] is Ellipsis:
+                return self[:][index]
+            frames = self[index[0]]
+            return frames[index[1:]] if isinstance(index[0], (int, np.integer)) else frames[(slice(None), *index[1:])]
+        if isinstance(index, (int, np.integer)):
+            if index < 0:
+                index += len(self)
+            if not 0 <= index < len(self):
+                raise IndexError(f'frame {index} out of range ({len(self)} frames)')
+            i = np.searchsorted(self.starts, index, side = 'right') - 1
+            return self.files[i][int(index - self.starts[i])]
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step == 1:
+                return self._read(start, stop)
+            index = np.arange(start, stop, step)
+        index = np.asarray(index)
+        if not len(index):
+            return np.zeros((0, *self.shape[1:]), dtype = self.dtype)
+        return np.stack([self[int(i)] for i in index])
+
+    def _read(self, start, stop):
+        out = np.empty((max(0, stop - start), *self.shape[1:]), dtype = self.dtype)
+        first = np.searchsorted(self.starts, start, side = 'right') - 1
+        position = start
+        for i in range(max(first, 0), len(self.files)):
+            if position >= stop:
+                break
+            file_stop = min(stop, self.starts[i + 1])
+            out[position - start:file_stop - start] = self.files[i][int(position - self.starts[i]):int(file_stop - self.starts[i])]
+            position = file_stop
+        return out
+
+    def __iter__(self):
+        for _, chunk in self.iter_chunks():
+            yield from chunk
+
+    def iter_chunks(self, chunk_size = 256):
+        """Yields (first frame index, frames) blocks of chunk_size frames"""
+        for start in range(0, len(self), chunk_size):
+            yield start, self._read(start, min(start + chunk_size, len(self)))
+
+    @property
+    def metadata(self):
+        """FRAME_METADATA_DTYPE records of all the frames (sidecars, or what each file has)"""
+        if self._metadata is None:
+            self._metadata = np.concatenate([np.asarray(f.metadata) for f in self.files])
+        return self._metadata
+
+    def frame_index(self, frame_id):
+        """Index of the frame(s) with camera frame_id, -1 if not recorded"""
+        ids = self.metadata['frame_id']
+        frame_id = np.asarray(frame_id)
+        if np.all(np.diff(ids) > 0):
+            index = np.clip(np.searchsorted(ids, frame_id), 0, len(ids) - 1)
+        else: # counter reset within the run
+            index = np.array([np.argmax(ids == i) for i in np.atleast_1d(frame_id)]).reshape(frame_id.shape)
+        return np.where(ids[index] == frame_id, index, -1)
+
+    def timestamp_index(self, timestamp, field = 'timestamp'):
+        """Index of the frame(s) closest to timestamp (field 'timestamp', 'host_timestamp_ns' or 'host_time_ns')"""
+        times = self.metadata[field]
+        index = np.clip(np.searchsorted(times, timestamp), 1, max(len(times) - 1, 1))
+        before = np.abs(np.asarray(timestamp) - times[index - 1]) <= np.abs(times[index] - np.asarray(timestamp))
+        return np.where(before, index - 1, index) if len(times) > 1 else np.zeros_like(index)
+
+    def close(self):
+        for f in self.files:
+            f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def _file_index(filepath):
+    """(run filepath, i) of {run filepath}_{i}.extension"""
+    stem = splitext(filepath)[0]
+    match = FILE_INDEX.match(basename(stem))
+    return (stem[:-len(match.group(2)) - 1], int(match.group(2))) if match else (stem, 0)
+
+def _starts_run(filepath):
+    """True if the sidecar of the file says it is the first file of a run"""
+    sidecar = get_sidecar_filepath(filepath)
+    if not isfile(sidecar):
+        return False
+    records = np.load(sidecar, mmap_mode = 'r')
+    return len(records) > 0 and records['file_index'][0] == 0
+
+def find_runs(filepath):
+    """Files of every run sharing the base name of filepath ({base}_{i}.extension), in order.
+    Several runs can share a base (the run numbering restarted); they are split where the
+    sidecar file_index goes back to 0."""
+    extension = splitext(filepath)[1]
+    base = _file_index(filepath)[0] if extension else filepath
+    candidates = glob.glob(glob.escape(base) + '_*' + (extension or '.*'))
+    files = sorted((f for f in candidates if _file_index(f)[0] == base and not f.endswith('.meta.npy')
+                    and not f.endswith('.json') and not f.endswith('.csv')),
+                   key = lambda f: _file_index(f)[1])
+    runs = []
+    for f in files:
+        if not runs or _starts_run(f):
+            runs.append([])
+        runs[-1].append(f)
+    return runs
+
+def _manifest_files(filepath):
+    with open(filepath) as f:
+        manifest = json.load(f)
+    return [join(dirname(filepath), chunk['file']) for chunk in manifest['chunks']]
+
+def open_recording(filepath):
+    """Opens a recording as one lazy array:
+        a file of the run ({run}_{i}.dat/.tif/.avi/.zarr): all the files of that run
+        a writer pool manifest ({run}_manifest.json): the chunks in frame order
+        the run filepath without index/extension: its first run
+    """
+    if filepath.endswith('_manifest.json'):
+        return Recording(_manifest_files(filepath))
+    if not exists(filepath) and isfile(filepath + '_manifest.json'):
+        return Recording(_manifest_files(filepath + '_manifest.json'))
+    runs = find_runs(filepath)
+    if exists(filepath): # zarr files are folders
+        for run in runs:
+            if filepath in run:
+                return Recording(run)
+        return Recording([filepath])
+    if not runs:
+        raise FileNotFoundError(f'No recording at {filepath}')
+    return Recording(runs[0])
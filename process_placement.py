@@ -0,0 +1,130 @@
+"""process_placement.py
+CPU affinity and scheduling priority of the camera and writer processes.
+Each process applies its own placement at the start of run() and logs the effective one.
+
+cam_dict keys (per camera):
+    'cpu_affinity'        : list of cpus for the camera loop, 'auto' (default) or None (left to the OS)
+    'priority'            : 'normal' (default), 'high', 'realtime' or a niceness (int)
+    'writer_cpu_affinity' : same, for the writer process ('auto' by default, None for a writer pool)
+    'writer_priority'     : same, for the writer process
+'auto' gives every camera one cpu for its loop and the next one for its writer, in the order
+the cameras are created, skipping the first cpu (GUI, OS). Cpus are ordered by NUMA node so a
+camera and its writer share a node. No auto placement on machines with less than 4 cpus.
+Writers that compress on a thread pool or pipe to a subprocess (tiff, compressed, zarr, ffmpeg)
+are not pinned by 'auto', their threads would share one cpu. Neither is the camera loop when
+such a writer runs as a thread of the camera process (writer_mode 'thread').
+'high' and 'realtime' usually need admin rights (Windows) or CAP_SYS_NICE (Linux).
+"""
+import os
+import glob
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+from NeuCams.utils import display
+
+AUTO_RESERVED_CPUS = 1 # first cpus left to the GUI and the OS
+REALTIME_FIFO_PRIORITY = 50 # SCHED_FIFO priority for 'realtime' on linux
+
+def get_cpus():
+    """Usable cpus, ordered by NUMA node"""
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = sorted(os.sched_getaffinity(0))
+    else:
+        cpus = list(range(os.cpu_count() or 1))
+    nodes = {}
+    for node_path in glob.glob('/sys/devices/system/node/node[0-9]*'):
+        try:
+            with open(os.path.join(node_path, 'cpulist')) as f:
+                for cpu in _parse_cpulist(f.read()):
+                    nodes[cpu] = int(os.path.basename(node_path)[4:])
+        except (OSError, ValueError):
+            continue
+    return sorted(cpus, key = lambda cpu: (nodes.get(cpu, 0), cpu))
+
+def _parse_cpulist(cpulist):
+    cpus = []
+    for part in cpulist.strip().split(','):
+        if '-' in part:
+            start, stop = part.split('-')
+            cpus.extend(range(int(start), int(stop) + 1))
+        elif part:
+            cpus.append(int(part))
+    return cpus
+
+def get_auto_affinity(index):
+    """(camera cpus, writer cpus) of the index-th camera, (None, None) on small machines"""
+    cpus = get_cpus()[AUTO_RESERVED_CPUS:]
+    if len(cpus) < 3:
+        return None, None
+    cam_cpu = cpus[(2 * index) % len(cpus)]
+    writer_cpu = cpus[(2 * index + 1) % len(cpus)]
+    return [cam_cpu], [writer_cpu]
+
+def get_placement(cam_dict, index, writer_threads = False, writer_mode = 'process', writer_pool = False):
+    """(camera placement, writer placement) dicts from the cam_dict keys, see apply_placement.
+    writer_threads: the writer uses a thread pool or a subprocess (FileWriter.uses_threads)
+    writer_pool: the writer is a WriterPool, its workers would share the one 'auto' cpu"""
+    auto_cam, auto_writer = get_auto_affinity(index)
+    if writer_threads:
+        auto_writer = None
+        if writer_mode == 'thread':
+            auto_cam = None
+    cam_cpus = cam_dict.get('cpu_affinity', 'auto')
+    writer_cpus = cam_dict.get('writer_cpu_affinity', None if writer_pool else 'auto')
+    return ({'cpus': auto_cam if cam_cpus == 'auto' else cam_cpus,
+             'priority': cam_dict.get('priority', 'normal')},
+            {'cpus': auto_writer if writer_cpus == 'auto' else writer_cpus,
+             'priority': cam_dict.get('writer_priority', 'normal')})
+
+def _set_affinity(cpus):
+    if psutil is not None:
+        psutil.Process().cpu_affinity(list(cpus))
+    elif hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+    else:
+        raise OSError('cpu affinity needs psutil on this platform')
+
+def _get_affinity():
+    if psutil is not None:
+        return psutil.Process().cpu_affinity()
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return None
+
+def _set_priority(priority):
+    if psutil is not None and os.name == 'nt':
+        classes = {'normal': psutil.NORMAL_PRIORITY_CLASS,
+                   'high': psutil.HIGH_PRIORITY_CLASS,
+                   'realtime': psutil.REALTIME_PRIORITY_CLASS}
+        psutil.Process().nice(classes[priority] if priority in classes else priority)
+    elif priority == 'realtime':
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(REALTIME_FIFO_PRIORITY))
+    elif priority == 'high':
+        os.setpriority(os.PRIO_PROCESS, 0, -10)
+    elif priority != 'normal':
+        os.setpriority(os.PRIO_PROCESS, 0, int(priority))
+
+def _get_priority():
+    if psutil is not None and os.name == 'nt':
+        return psutil.Process().nice()
+    if hasattr(os, 'sched_getscheduler') and os.sched_getscheduler(0) == os.SCHED_FIFO:
+        return f'SCHED_FIFO {os.sched_getparam(0).sched_priority}'
+    if hasattr(os, 'getpriority'):
+        return f'nice {os.getpriority(os.PRIO_PROCESS, 0)}'
+    return None
+
+def apply_placement(name, cpus = None, priority = 'normal'):
+    """Applies the placement to the calling process and logs the effective one"""
+    if cpus:
+        try:
+            _set_affinity(cpus)
+        except Exception as e: # OSError, psutil.AccessDenied
+            display(f'[{name}] could not set the cpu affinity {cpus}: {e}', level='warning')
+    if priority not in [None, 'normal']:
+        try:
+            _set_priority(priority)
+        except Exception as e:
+            display(f'[{name}] could not set the priority {priority}: {e}', level='warning')
+    display(f'[{name}] pid {os.getpid()} - cpus: {_get_affinity()}, priority: {_get_priority()}')
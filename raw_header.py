@@ -0,0 +1,71 @@
+"""raw_header.py
+Header of the raw (.dat) files written by the BinaryWriter.
+The frames follow the RAW_HEADER_SIZE bytes header, C order, frame after frame:
+    magic       8s   b'NEUCRAW\\x01'
+    header_size u4   offset of the first frame
+    n_chan      u4
+    height      u4
+    width       u4
+    dtype       8s   numpy dtype string, e.g. b'<u2'
+    frame_count u8   frames in the file, updated every time a block of frames reaches
+                     the file and on close (a crashed run still reads up to there)
+    frame_nbytes u8
+    codec       8s   b'' for raw frames, b'zstd' or b'lz4' (CompressedWriter)
+    group_frames u4  frames compressed together
+    filters     u4   RAW_SHUFFLE: bytes shuffled before compression
+    index_offset u8  offset of the group index, 0 if the file was not closed
+Compressed files store groups of group_frames frames after the header, each one as
+RAW_GROUP_HEADER (compressed nbytes, n_frames) followed by the compressed bytes, and end with
+the index: uint64 offsets of the groups, then the end of the last group.
+Files written before the codec fields have zeros there (raw frames).
+Older raw files have no header, their format is in the filename (_{n_chan}_{H}_{W}_{dtype}.dat).
+"""
+import struct
+import numpy as np
+
+RAW_MAGIC = b'NEUCRAW\x01'
+RAW_HEADER_SIZE = 4096 # keeps the frames aligned for unbuffered/direct reads
+_RAW_HEADER_STRUCT = struct.Struct('<8sIIII8sQQ8sIIQ')
+RAW_GROUP_HEADER = struct.Struct('<II')
+RAW_CODECS = ['zstd', 'lz4']
+RAW_SHUFFLE = 1
+
+def pack_raw_header(shape, dtype, frame_count = 0, codec = '', group_frames = 1, filters = 0, index_offset = 0):
+    """shape: (height, width[, n_chan])"""
+    height, width = shape[:2]
+    n_chan = shape[2] if len(shape) > 2 else 1
+    dtype = np.dtype(dtype)
+    header = _RAW_HEADER_STRUCT.pack(RAW_MAGIC, RAW_HEADER_SIZE, n_chan, height, width,
+                                     dtype.str.encode(), frame_count,
+                                     height * width * n_chan * dtype.itemsize,
+                                     codec.encode(), group_frames, filters, index_offset)
+    return header.ljust(RAW_HEADER_SIZE, b'\0')
+
+def get_raw_codecs(codec, filters = 0, itemsize = 1, level = None):
+    """numcodecs codecs to apply in order (decode in reverse order)"""
+    import numcodecs
+    codecs = [numcodecs.Shuffle(elementsize = itemsize)] if filters & RAW_SHUFFLE and itemsize > 1 else []
+    if codec == 'zstd':
+        codecs.append(numcodecs.Zstd(level = 1 if level is None else level))
+    elif codec == 'lz4':
+        codecs.append(numcodecs.LZ4(acceleration = 1 if level is None else level))
+    else:
+        raise ValueError(f'Unknown raw codec {codec}')
+    return codecs
+
+def read_raw_header(fileobj):
+    """Returns the header as a dict or None if the file has no header"""
+    data = fileobj.read(_RAW_HEADER_STRUCT.size)
+    if len(data) < _RAW_HEADER_STRUCT.size or not data.startswith(RAW_MAGIC):
+        return None
+    (_, header_size, n_chan, height, width, dtype, frame_count, frame_nbytes,
+     codec, group_frames, filters, index_offset) = _RAW_HEADER_STRUCT.unpack(data)
+    return {'header_size': header_size,
+            'shape': (height, width, n_chan),
+            'dtype': np.dtype(dtype.rstrip(b'\0').decode()),
+            'frame_count': frame_count,
+            'frame_nbytes': frame_nbytes,
+            'codec': codec.rstrip(b'\0').decode(),
+            'group_frames': max(group_frames, 1),
+            'filters': filters,
+            'index_offset': index_offset}
@@ -0,0 +1,163 @@
+"""shared_buffers.py
+Preallocated shared-memory frame storage.
+Frames are copied once into fixed slots and only slot indices are passed around,
+so there is no per-frame allocation or shm_open/unlink in the acquisition loop.
+"""
+import os
+import ctypes
+import numpy as np
+from multiprocessing import shared_memory
+from multiprocessing.sharedctypes import RawArray
+
+from NeuCams.utils import display
+
+
+class SharedFrameRing:
+    """Fixed-size ring of N frame slots in a single shared memory segment.
+    ring[i] returns a numpy view on slot i (no copy), the caller decides which slot to fill.
+    The segment is created once; the creating process owns it and unlinks it on close.
+    With private=True the name is unlinked right away (POSIX): the mapping stays valid for
+    this process, but nothing is left behind in /dev/shm if the process dies.
+    A non-private ring can be handed to a child process (pickled by name and re-attached,
+    or inherited on fork); only the creating process removes the segment.
+    """
+    def __init__(self, n_slots, shape, dtype, private = False):
+        self.n_slots = int(n_slots)
+        self.shape = tuple(int(s) for s in shape)
+        self.dtype = np.dtype(dtype)
+        self.slot_nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.private = private
+        self._shm = shared_memory.SharedMemory(create = True,
+                                               size = max(1, self.n_slots * self.slot_nbytes))
+        self._owner_pid = os.getpid()
+        self._is_linked = True
+        if private:
+            self._unlink()
+        self._init_frames()
+
+    def _init_frames(self):
+        self.frames = np.ndarray((self.n_slots, *self.shape), dtype = self.dtype,
+                                 buffer = self._shm.buf)
+
+    def __getstate__(self):
+        if self.private:
+            raise TypeError('A private SharedFrameRing can not be shared with another process.')
+        return {'name': self._shm.name, 'n_slots': self.n_slots, 'shape': self.shape,
+                'dtype': self.dtype.str, 'private': False}
+
+    def __setstate__(self, state):
+        self.n_slots = state['n_slots']
+        self.shape = tuple(state['shape'])
+        self.dtype = np.dtype(state['dtype'])
+        self.slot_nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.private = False
+        self._shm = shared_memory.SharedMemory(name = state['name'])
+        self._owner_pid = None
+        self._is_linked = True
+        self._init_frames()
+
+    def __len__(self):
+        return self.n_slots
+
+    def __getitem__(self, slot):
+        return self.frames[slot]
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    @property
+    def nbytes(self):
+        return self.n_slots * self.slot_nbytes
+
+    def matches(self, shape, dtype):
+        return tuple(shape) == self.shape and np.dtype(dtype) == self.dtype
+
+    def _unlink(self):
+        if self._is_linked:
+            try:
+                self._shm.unlink()
+            except FileNotFoundError:
+                pass
+            self._is_linked = False
+
+    def close(self):
+        """Releases the mapping, the owner also removes the segment"""
+        self.frames = None
+        try:
+            self._shm.close()
+        except BufferError:
+            # views on a slot are still alive somewhere, the mapping goes with them
+            display('SharedFrameRing closed while frames are still referenced.', level = 'warning')
+        if self._owner_pid == os.getpid():
+            self._unlink()
+
+
+class LiveFrameBuffer:
+    """Triple-buffered latest frame for the live view, shared between processes.
+    The acquisition process writes with write() and never blocks; readers copy the latest
+    complete frame with read() and can skip the copy when nothing new was written.
+    Lock-free: one 64 bit header word holds (sequence number << 2 | latest slot) and is
+    updated with a single store, every slot has its own sequence counter (odd while it
+    is being written, seqlock) so a reader that got lapped by the writer retries instead
+    of returning a torn frame. Single writer, any number of readers.
+    """
+    n_slots = 3
+    max_read_attempts = 3
+    
+    def __init__(self, shape, dtype):
+        self.shape = tuple(int(s) for s in shape)
+        self.dtype = np.dtype(dtype)
+        nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self._raw_frames = RawArray(ctypes.c_ubyte, max(1, self.n_slots * nbytes))
+        # [seq << 2 | latest slot, slot 0 seq, slot 1 seq, slot 2 seq]
+        self._raw_header = RawArray(ctypes.c_int64, 1 + self.n_slots)
+        self._init_views()
+    
+    def _init_views(self):
+        self.frames = np.frombuffer(self._raw_frames, dtype = self.dtype,
+                                    count = self.n_slots * int(np.prod(self.shape))
+                                    ).reshape((self.n_slots, *self.shape))
+        self.header = np.frombuffer(self._raw_header, dtype = np.int64)
+    
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['frames'], state['header']
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_views()
+    
+    @property
+    def seq(self):
+        return int(self.header[0]) >> 2
+    
+    def write(self, frame):
+        """Copies frame into the slot that is not the latest, then publishes it"""
+        word = int(self.header[0])
+        seq, latest = word >> 2, word & 3
+        slot = (latest + 1) % self.n_slots
+        self.header[1 + slot] += 1 # odd: slot is being written
+        self.frames[slot] = np.reshape(frame, self.shape)
+        self.header[1 + slot] += 1
+        self.header[0] = ((seq + 1) << 2) | slot
+        return seq + 1
+    
+    def read(self, last_seq = None, out = None):
+        """Returns (frame copy, seq) of the latest frame, (None, seq) if seq == last_seq
+        or if the writer kept overwriting the slot while it was copied."""
+        for _ in range(self.max_read_attempts):
+            word = int(self.header[0])
+            seq, slot = word >> 2, word & 3
+            if seq == 0 or seq == last_seq:
+                return None, seq
+            slot_seq = int(self.header[1 + slot])
+            if slot_seq & 1:
+                continue
+            if out is None:
+                out = np.empty(self.shape, dtype = self.dtype)
+            out[:] = self.frames[slot]
+            if int(self.header[1 + slot]) == slot_seq:
+                return out, seq
+        return None, last_seq
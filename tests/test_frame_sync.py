@@ -0,0 +1,49 @@
+import time
+import queue
+import numpy as np
+import pytest
+
+file_writer = pytest.importorskip('NeuCams.file_writer')
+from NeuCams.frame_sync import SyncLog
+from NeuCams.frame_metadata import make_metadata_records
+from NeuCams.io import open_recording
+
+FRAME_FORMAT = {'height': 4, 'width': 4, 'n_chan': 1, 'dtype': np.uint16}
+
+class SlowWriter(file_writer.BinaryWriter):
+    def _write_frames(self, frames, records):
+        time.sleep(0.01)
+        super()._write_frames(frames, records)
+
+def _read_sync_log(sync_log):
+    rows, ends = [], []
+    while True:
+        try:
+            message = sync_log.queue.get(timeout = 0.5)
+        except queue.Empty:
+            return (np.concatenate(rows) if rows else np.zeros((0, 3), np.int64)), ends
+        if message[0] == 'frames':
+            rows.append(message[1])
+        else:
+            ends.append(message[1])
+
+@pytest.mark.parametrize('overflow_policy', ['drop_newest', 'drop_oldest'])
+def test_sync_rows_of_written_frames(tmp_path, overflow_policy):
+    """Frames the writer dropped (the new ones or older queued ones) get no sync row"""
+    filepath = str(tmp_path / 'run')
+    sync_log = SyncLog()
+    sync_log.enabled.set()
+    writer = SlowWriter(filepath = filepath, frame_format = FRAME_FORMAT, writer_mode = 'thread',
+                        max_queue_frames = 4, overflow_policy = overflow_policy, sync_log = sync_log)
+    with writer:
+        writer.set_filepath(filepath)
+        run_file = writer.get_filepath()
+        for start in range(0, 60, 3):
+            frames = np.zeros((3, 4, 4, 1), np.uint16)
+            writer.save_batch(frames, make_metadata_records([(i, i * 0.001) for i in range(start, start + 3)]))
+        writer.set_filepath(filepath)
+    rows, ends = _read_sync_log(sync_log)
+    recording = open_recording(run_file)
+    assert writer.counters.dropped.value > 0
+    assert rows[:, 0].tolist() == recording.metadata['frame_id'].tolist()
+    assert len(recording) in ends
@@ -0,0 +1,43 @@
+import time
+import numpy as np
+import pytest
+
+pytest.importorskip('zarr')
+file_writer = pytest.importorskip('NeuCams.file_writer')
+from NeuCams.frame_metadata import make_metadata_records
+from NeuCams.io import open_recording
+
+FRAME_FORMAT = {'height': 8, 'width': 6, 'n_chan': 1, 'dtype': np.uint16}
+
+def _batch(start, n):
+    frames = np.arange(start, start + n, dtype = np.uint16)[:, None, None, None] * np.ones((1, 8, 6, 1), np.uint16)
+    return frames, make_metadata_records([(i, i * 0.01) for i in range(start, start + n)])
+
+def _wait_written(writer, timeout = 10.):
+    """Waits until the writer handled every queued frame, True if it is still running"""
+    t_stop = time.time() + timeout
+    while writer.counters.queue_depth.value > 0 and writer.is_alive() and time.time() < t_stop:
+        time.sleep(0.01)
+    return writer.is_alive()
+
+def test_zarr_writer_thread_mode_two_runs(tmp_path):
+    """The zarr chunk buffer and the pool chunk tag are different attributes: a thread writer
+    (save() and the writer loop on the same object) keeps writing across runs"""
+    filepath = str(tmp_path / 'run')
+    writer = file_writer.ZarrWriter(filepath = filepath, frame_format = FRAME_FORMAT, writer_mode = 'thread',
+                                    chunk_frames = 4)
+    with writer:
+        run_files = []
+        for run in range(2):
+            writer.set_filepath(filepath)
+            run_files.append(writer.get_filepath())
+            for start in range(0, 10, 5):
+                assert writer.save_batch(*_batch(start, 5)) == 5
+            assert writer.save(np.full((8, 6, 1), 10, np.uint16), (10, 0.1))
+            assert _wait_written(writer) # set_filepath would wait forever for a dead writer
+        writer.set_filepath(filepath)
+    for run_file in run_files:
+        recording = open_recording(run_file)
+        assert len(recording) == 11
+        assert recording.metadata['frame_id'].tolist() == list(range(11))
+        assert (recording[0:len(recording)][:, 0, 0, 0] == np.arange(11)).all()
@@ -1,4 +1,6 @@
 import sys
+import os
+import pickle
 from os import path, makedirs
 from datetime import datetime
 import json
@@ -18,6 +20,58 @@ def display(s, level='info'):
     log_func = getattr(logging, level, logging.info)
     log_func(s)
 
+TRANSPORT_CHECK_ENV = 'NEUCAMS_TRANSPORT_CHECK'
+
+class TransportMonitor:
+    """Opt-in transport self-check.
+    Pickles 1 in `every` payloads and reports the measured size and serialization cost.
+    every = 0 (default) disables it, the hot path then does no extra serialization.
+    The NEUCAMS_TRANSPORT_CHECK environment variable overrides the configured value.
+    """
+    def __init__(self, every = 0, name = ''):
+        every = os.environ.get(TRANSPORT_CHECK_ENV, every)
+        try:
+            self.every = max(0, int(every or 0))
+        except ValueError:
+            display(f'Invalid {TRANSPORT_CHECK_ENV} value: {every}', level='warning')
+            self.every = 0
+        self.name = name
+        self.count = 0
+        self.reset()
+    
+    def reset(self):
+        self.samples = 0
+        self.total_bytes = 0
+        self.total_time = 0.
+        self.max_time = 0.
+    
+    def check(self, payload):
+        if not self.every:
+            return
+        self.count += 1
+        if self.count % self.every:
+            return
+        tstart = time.perf_counter()
+        try:
+            nbytes = len(pickle.dumps(payload, protocol = pickle.HIGHEST_PROTOCOL))
+        except Exception as e:
+            display(f'[{self.name}] transport check: payload {type(payload)} is not picklable: {e}', level='error')
+            return
+        dt = time.perf_counter() - tstart
+        self.samples += 1
+        self.total_bytes += nbytes
+        self.total_time += dt
+        self.max_time = max(self.max_time, dt)
+        display(f'[{self.name}] transport check: {nbytes/1e6:.3f} MB pickled in {dt*1e3:.3f} ms')
+    
+    def report(self):
+        if self.samples:
+            display(f'[{self.name}] transport check over {self.samples} samples: '
+                    f'mean {self.total_bytes/self.samples/1e6:.3f} MB, '
+                    f'mean {self.total_time/self.samples*1e3:.3f} ms, max {self.max_time*1e3:.3f} ms, '
+                    f'{self.total_bytes/max(self.total_time, 1e-9)/1e6:.1f} MB/s')
+        self.reset()
+
 DEFAULT_SERVER_PARAMS = {
                          'server': 'udp',
                          'server_refresh_time':30, #ms
@@ -28,8 +82,12 @@ DEFAULT_RECORDER_PARAMS = {
                             'recorder' : 'opencv',
                             'data_folder': 'C:\\Users\\User\\data',
                             'experiment_folder': 'EXP_TEST',
-                            'frames_per_file': 256,
-                            'compress': 0
+                            'frames_per_file': 0, # 0: each writer chooses (tiff: max_file_gb, writer pool: 256, others: one file per run)
+                            'compress': 0,
+                            'writer_mode': 'process',
+                            'transport': 'queue',
+                            'max_queue_frames': 0,
+                            'overflow_policy': 'drop_newest'
                           }
 
 DEFAULT_CAM_INFOS = [
@@ -4,7 +4,6 @@ import time
 import numpy as np
 
 from .components import DisplaySettingsWidget
-from NeuCams.cams.avt_cam import AVTCam
 
 def nparray_to_qimg(img):
     if len(img.shape) == 2:
@@ -19,11 +19,11 @@ from .image_processing import (HistogramStretcher, ImageFlipper,
 from NeuCams.udp_socket import UDPSocket
 from NeuCams.utils import display
 from NeuCams.camera_handler import CameraHandler
+from NeuCams.frame_sync import FrameSyncCoordinator
 
 # Re-use the existing CamWidget implementation (and its helpers) from the legacy GUI.
 from NeuCams.view.components import DisplaySettingsWidget, ImageProcessingWidget
 from NeuCams.view.base_widgets import BaseCameraWidget, nparray_to_qimg
-from NeuCams.cams.avt_cam import AVTCam
 
 # -----------------------------------------------------------------------------
 # Paths
@@ -94,6 +94,18 @@ class PyCamsWindow(QMainWindow):
         # Arrange the camera windows in a grid
         self.mdiArea.tileSubWindows()
 
+        # ------------------------------------------------------------------
+        # Optional live frame synchronization across cameras
+        # ------------------------------------------------------------------
+        self.frame_sync = None
+        sync_params = dict(self.preferences.get('sync_params', {}))
+        if sync_params and len(self.cam_widgets) > 1:
+            refresh_time = sync_params.pop('refresh_time', 200) # ms
+            self.frame_sync = FrameSyncCoordinator([w.cam_handler for w in self.cam_widgets], **sync_params)
+            self._sync_timer = QTimer(self)
+            self._sync_timer.timeout.connect(self.frame_sync.process)
+            self._sync_timer.start(refresh_time)
+
         # ------------------------------------------------------------------
         # Optional UDP server (one per process)
         # ------------------------------------------------------------------
@@ -182,14 +194,29 @@ class PyCamsWindow(QMainWindow):
             self.server.send('ok=stop', address)
 
         elif action == 'done?':
-            cam_descr = value[0] if value else ''
+            # done?=<cam> or done?=<cam>,dropped to also get the dropped frame count of the run
+            cam_descr, *fields = value[0].split(',') if value else ['']
             for cam_widget in self.cam_widgets:
                 if cam_widget.cam_handler.cam_dict.get('description') == cam_descr:
                     status = cam_widget.cam_handler.is_acquisition_done.is_set()
-                    self.server.send(f'done?={status}', address)
+                    if 'dropped' in fields:
+                        dropped = cam_widget.cam_handler.gap_detector.dropped_run.value
+                        self.server.send(f'done?={status},dropped={dropped}', address)
+                    else:
+                        self.server.send(f'done?={status}', address)
                     return
             self.server.send('done?=camera not found', address)
 
+        elif action == 'writer?':
+            cam_descr = value[0] if value else ''
+            for cam_widget in self.cam_widgets:
+                if cam_widget.cam_handler.cam_dict.get('description') == cam_descr:
+                    counters = cam_widget.cam_handler.writer_counters.as_dict()
+                    reply = ','.join(f'{key}:{val}' for key, val in counters.items())
+                    self.server.send(f'writer?={reply}', address)
+                    return
+            self.server.send('writer?=camera not found', address)
+
         elif action == 'quit':
             display(f'Exiting [{address}]')
             self.server.send('ok=bye', address)
@@ -235,6 +262,8 @@ class PyCamsWindow(QMainWindow):
     def close(self):
         for cam_widget in self.cam_widgets:
             cam_widget.cam_handler.close()
+        if self.frame_sync is not None:
+            self.frame_sync.close()
         time.sleep(0.5)
         display("PyCams out, bye!")
         QApplication.quit()
@@ -269,17 +298,11 @@ class CamWidget(BaseCameraWidget):
             return
         dest = self.cam_handler.get_filepath()
         self.save_location_label.setText('Filepath: ' + dest)
-        if self.frame_nr != self.cam_handler.total_frames.value:
-            img = self.cam_handler.get_image()
-            if isinstance(img, tuple) and len(img) == 3 and isinstance(img[0], str):
-                shm_name, shape, dtype = img
-                img, shm = AVTCam.frame_from_shm(shm_name, shape, dtype)
-                img = np.array(img, copy=True)
-                shm.close()
-                shm.unlink()
-            self.original_img = np.copy(img)
+        img, seq = self.cam_handler.get_latest_image(self.frame_nr)
+        if img is not None:
+            self.original_img = img
             self.is_img_processed = False
-            self.frame_nr = self.cam_handler.total_frames.value
+            self.frame_nr = seq
         self._update_stats()
         if self.cam_handler.start_trigger.is_set() and not self.cam_handler.stop_trigger.is_set():
             self._set_stop_text()
@@ -302,7 +325,14 @@ class CamWidget(BaseCameraWidget):
             self.fps_label.setText(f"{avg_fps:.1f} fps")
             self._prev_time = current_time
             self._prev_frame_nr = current_frame
-        self.frame_nr_label.setText(f"frame: {current_frame}")
+        text = f"frame: {current_frame}"
+        dropped = self.cam_handler.gap_detector.dropped_run.value
+        if dropped > 0:
+            text += f" (dropped: {dropped})"
+        not_saved = self.cam_handler.writer_counters.dropped.value
+        if not_saved > 0:
+            text += f" (not saved: {not_saved})"
+        self.frame_nr_label.setText(text)
 
     def _update_img(self):
         if self.original_img is not None: